@@ -5,87 +5,212 @@
 import streamlit as st
 import sys
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+process_start = time.perf_counter()
+
 from text_sql_athena.custom_logger import logger
 from text_sql_athena.aws_client_factory import AwsClientFactory
-from text_sql_athena.chromadb_vc_embedding import EmbeddingBedrockChroma
-from text_sql_athena.glue_table_schema_loader import GlueTableSchemaLoader
-from text_sql_athena.llm_basemodel import LanguageModel
-from text_sql_athena.sql_generator import RequestQueryBedrock
-from text_sql_athena.vector_embedding import EmbeddingBedrock
+from text_sql_athena.telemetry import telemetry
+
+# langchain, chromadb and pandas take seconds to import, they are imported by the background initialization
+# below or on the code path that needs them so the page renders without waiting for them
 
 # Variables
 region = "us-east-1"
 chromadb_path = "./chroma.db"
+vector_store_backend = "chroma" # "chroma", or "numpy" for the memory-mapped index stored in vector_index_path
+vector_index_path = "./vector_index"
+hierarchical_retrieval = True # Ranks the tables first, then searches the columns of the best tables only
 athena_bucket_name='athena-storage-silvanly'
+athena_workgroup = None # Workgroup of the executions, the primary workgroup when None
+athena_output_location = None # S3 prefix of the results, s3://<athena_bucket_name>/ when None
+athena_result_reuse_minutes = None # Identical queries run within this age reuse the previous result without scanning data, CSV format only
+athena_result_format = "parquet" # "parquet" reads typed results written by UNLOAD, "csv" parses the Athena CSV output
+athena_execution_cache_minutes = 60 # Identical queries run within this age read the previous result files again, in both formats
+athena_max_concurrent_queries = 20 # Executions running at once for all the sessions, under the active query quota of the account
 llm_model_id = "us.anthropic.claude-3-5-sonnet-20241022-v2:0"
 embedding_model_id ="amazon.titan-embed-text-v1"
-
+embedding_cache_path = "./embedding_cache.db"
+prompt_caching = False # Set to True when the LLM supports Bedrock prompt caching
+speculative_candidates = 1 # Above 1, several SQL candidates are generated and validated in parallel at each attempt
+glue_databases_ttl = 300 # Seconds the list of Glue databases is cached
+metrics_port = 9464 # Port of the Prometheus /metrics endpoint, None disables it
+payload_log_sample_rate = 0.01 # Ratio of the questions and Glue tables written to the logs
+
+page_start = time.perf_counter()
 logger.info("Loading the page")
 
 @st.cache_resource
-def get_client_factory():
-    return AwsClientFactory()
+def start_metrics_server():
+    # Once per process, the endpoint outlives the reruns of the script
+    telemetry.payload_sample_rate = payload_log_sample_rate
+    if metrics_port is None:
+        return None
+    try:
+        return telemetry.start_http_server(metrics_port)
+    except OSError as e:
+        logger.warning(f"Metrics endpoint not started on port {metrics_port}: {e}")
+        return None
 
 @st.cache_resource
-def get_language_model(region, _client_factory: AwsClientFactory):    
-    return LanguageModel(bedrock_client= _client_factory.createBedrockRuntimeClient(), region_name=region, embed_model_id=embedding_model_id, llm_model_id=llm_model_id)
+def get_client_factory():
+    # Shared by every session, the clients are created at startup instead of on the first request.
+    # The Athena throttling errors are left to the execution scheduler instead of the botocore retries.
+    from text_sql_athena.athena_scheduler import SCHEDULED_CLIENT_SETTINGS
+    return AwsClientFactory(service_settings=SCHEDULED_CLIENT_SETTINGS).warm_up()
 
 @st.cache_resource
-def get_chromadb_component(chromadb_path:str, _embedding_bedrock: EmbeddingBedrock, _language_model: LanguageModel):
-    return EmbeddingBedrockChroma( chromadb_path=chromadb_path, 
-                                language_model=_language_model, 
-                                embedding_bedrock=_embedding_bedrock)
+def get_execution_scheduler():
+    # Shared by every session: the EXPLAINs and queries of all the users are admitted by the same scheduler
+    from text_sql_athena.athena_scheduler import AthenaExecutionScheduler
+    return AthenaExecutionScheduler(max_concurrent_queries=athena_max_concurrent_queries)
 
+@st.cache_resource
+def get_query_executor(_client_factory: AwsClientFactory):
+    from text_sql_athena.athena_execution import AthenaQueryExecute, ExecutionIdCache
+    return AthenaQueryExecute(_client_factory, athena_bucket_name, workgroup=athena_workgroup, output_location=athena_output_location,
+                              result_reuse_minutes=athena_result_reuse_minutes, result_format=athena_result_format,
+                              execution_cache=ExecutionIdCache(max_age_seconds=athena_execution_cache_minutes * 60),
+                              scheduler=get_execution_scheduler())
+
+class Components:
+    """Heavy components shared by every session."""
+    def __init__(self, language_model, ebr_chroma, sql_cache):
+        self.language_model = language_model
+        self.ebr_chroma = ebr_chroma
+        self.sql_cache = sql_cache
+
+def build_components(client_factory: AwsClientFactory) -> Components:
+    start = time.perf_counter()
+    from text_sql_athena.chromadb_vc_embedding import EmbeddingBedrockChroma
+    from text_sql_athena.llm_basemodel import LanguageModel
+    from text_sql_athena.sql_cache import SemanticSqlCache
+    from text_sql_athena.vector_embedding import EmbeddingBedrock
+    from text_sql_athena.vector_store import NumpyVectorStore
+    logger.info(f"Modules imported in {time.perf_counter() - start:.2f}s")
+
+    language_model = LanguageModel(bedrock_client=client_factory.createBedrockRuntimeClient(), region_name=region, embed_model_id=embedding_model_id,
+                                   llm_model_id=llm_model_id, embedding_cache_path=embedding_cache_path)
+    vector_store = NumpyVectorStore(vector_index_path) if vector_store_backend == "numpy" else None
+    ebr_chroma = EmbeddingBedrockChroma(chromadb_path=chromadb_path,
+                                        language_model=language_model,
+                                        embedding_bedrock=EmbeddingBedrock(language_model),
+                                        vector_store=vector_store,
+                                        hierarchical=hierarchical_retrieval)
+    logger.info(f"Components initialized in {time.perf_counter() - start:.2f}s")
+    return Components(language_model, ebr_chroma, SemanticSqlCache())
 
+@st.cache_resource
+def get_components_future(_client_factory: AwsClientFactory) -> Future:
+    # Started on the first page load, the page renders while the components are being built
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="applet-init")
+    future = executor.submit(build_components, _client_factory)
+    executor.shutdown(wait=False)
+    return future
+
+def get_components() -> Components:
+    future = get_components_future(client_factory)
+    if future.done() and future.exception() is not None:
+        # A failed build is not kept in the cache, this rerun builds the components again
+        logger.warning(f"Building the components failed ({future.exception()}), retrying")
+        get_components_future.clear()
+        future = get_components_future(client_factory)
+    if not future.done():
+        with st.spinner("Loading the language model and the vector database..."):
+            return future.result()
+    return future.result()
+
+@st.cache_data(ttl=glue_databases_ttl, show_spinner=False)
+def get_glue_database_names(_client_factory: AwsClientFactory) -> list[str]:
+    start = time.perf_counter()
+    paginator = _client_factory.createGlueClient().get_paginator('get_databases')
+    databases = [database['Name'] for page in paginator.paginate() for database in page['DatabaseList']]
+    logger.info(f"{len(databases)} Glue databases listed in {time.perf_counter() - start:.2f}s")
+    return databases
+
+
+start_metrics_server()
 client_factory = get_client_factory()
-language_model = get_language_model(region , client_factory)
-embedding_bedrock = EmbeddingBedrock(language_model)
-ebr_chroma = get_chromadb_component(chromadb_path, embedding_bedrock, _language_model=language_model)
+get_components_future(client_factory)
+logger.info(f"Clients ready {time.perf_counter() - process_start:.2f}s after the script start")
 
-def userinput(rqst: RequestQueryBedrock, user_query: str):
-    logger.info(f'Searching metadata from vector store')
-    vector_search_match=rqst.getEmbedding( user_query)
-
-    details="It is important that the SQL query complies with Athena syntax. During join if column name are same please use alias ex llm.customer_id in select statement. It is also important to respect the type of columns: if a column is string, the value should be enclosed in quotes. If you are writing CTEs then include all the required columns. While concatenating a non string column, make sure cast the column to string. For date columns comparing to string , please cast the string input. Alwayws use the database name along with the table name"
-    final_question = "\n\nHuman:"+details + vector_search_match + user_query+ "n\nAssistant:"
-    logger.info("FINAL QUESTION :::" + final_question)
+def userinput(rqst, user_query: str):
+    telemetry.log_payload("FINAL QUESTION ::: %s", user_query)
 
     # Use st.empty to create a placeholder for messages
     message_container = st.empty()
     
-    answer = rqst.generate_sql(final_question, message_container)
+    with telemetry.span("answer"):
+        answer = rqst.answer(user_query, message_container, streaming=True)
     return answer
 
 st.title("Text to Athena Applet");
 st.write("Please type the query you want to execute with Athena")
 query = st.text_input("Prompt for Athena", "Give me an unique list of hosts detected by the agents and that has Linux as an operation system.")
 
+all_databases = "All databases"
+searched_database = st.selectbox("Search the schema of", [all_databases] + get_glue_database_names(client_factory))
+execute_generated_query = st.checkbox("Execute the generated query in Athena and display the results")
+max_displayed_rows = 10000
+displayed_chunk_rows = 1000 # Rows fetched between two updates of the result table
+
 # st.session_state.query
 if st.button('Generate the Query'):
+    from text_sql_athena.sql_generator import RequestQueryBedrock
+    components = get_components()
     st.subheader('Sql statement for Athena')
-    results = ebr_chroma.get_similarity_search(query)
-    result_data = ebr_chroma.transform_data(results)
-
-    
-    rqst=RequestQueryBedrock(ebr_chroma, client_factory, athena_bucket_name, language_model=language_model)
-    sqlquery = userinput(rqst, query)
+    rqst=RequestQueryBedrock(components.ebr_chroma, client_factory, athena_bucket_name, language_model=components.language_model, prompt_caching=prompt_caching,
+                             sql_cache=components.sql_cache, speculative_candidates=speculative_candidates,
+                             database_name=None if searched_database == all_databases else searched_database,
+                             query_executor=get_query_executor(client_factory))
+    answer = userinput(rqst, query)
+    sqlquery = answer.sql_query
     st.markdown(f"""
                 ```sql
                 {sqlquery}
                 ```""")
+
+    context = answer.context
+    if answer.from_cache:
+        st.caption("Validated query reused from the cache of similar questions")
+    else:
+        st.caption(f"Schema context: {context.stats.tokens_used} tokens used, {context.stats.tokens_saved} tokens saved "
+                   f"({context.stats.documents_used}/{context.stats.documents_retrieved} documents)")
+        with st.expander(f"Matched schema ({len(context.documents)} documents)"):
+            st.dataframe([{"id": doc["id"], "distance": doc["distance"], **(doc["metadata"] or {})} for doc in context.documents])
+
+    if execute_generated_query and sqlquery:
+        import pandas as pd
+        from text_sql_athena.athena_execution import AthenaQueryError
+        st.subheader('Query results')
+        status_container = st.empty()
+        table_container = st.empty()
+        chunks = []
+        loaded_rows = rendered_rows = 0
+        try:
+            for chunk in rqst.sqlsyntax_checker.iter_query_results(sqlquery, chunksize=displayed_chunk_rows, max_rows=max_displayed_rows):
+                chunks.append(chunk)
+                loaded_rows += len(chunk)
+                # Rendered again each time the row count doubles, the copies stay linear in the number of rows
+                if loaded_rows >= 2 * rendered_rows:
+                    table_container.dataframe(pd.concat(chunks, ignore_index=True))
+                    rendered_rows = loaded_rows
+                status_container.text(f"{loaded_rows} rows loaded...")
+            if loaded_rows > rendered_rows:
+                table_container.dataframe(pd.concat(chunks, ignore_index=True))
+            status_container.text(f"{loaded_rows} rows loaded (display limited to {max_displayed_rows} rows)")
+        except AthenaQueryError as e:
+            status_container.error(str(e))
     
 ## Metadata import
 st.markdown("## Import Glue database metadata")
 st.write("You can import the schemas of your AWS Glue table as embedding to improve the accuracy of the engine")
 
-# Display combobox with the list of Glue databases
-glueSchema = GlueTableSchemaLoader(client_factory=client_factory, chromaEmbeddingDB=ebr_chroma, region=region, language_model=language_model)
-databases = glueSchema.get_glue_databases()
-
-def get_glue_database_name(database_item):
-    return database_item['Name']
-
-databases = list(map(get_glue_database_name, databases))
+# Display combobox with the list of Glue databases, cached for glue_databases_ttl seconds
+# Cleared in a callback, which runs before the rerun: the selectbox at the top of the page gets the new list too
+st.button("Refresh the database list", on_click=get_glue_database_names.clear)
+databases = get_glue_database_names(client_factory)
 
 database_selection = st.selectbox(
     "Select a Glue Database",
@@ -94,6 +219,10 @@ database_selection = st.selectbox(
 
 # Launch import
 if st.button("Import metadata from Glue database"):
+    from text_sql_athena.glue_table_schema_loader import GlueTableSchemaLoader
+    components = get_components()
+    glueSchema = GlueTableSchemaLoader(client_factory=client_factory, chromaEmbeddingDB=components.ebr_chroma, region=region,
+                                       language_model=components.language_model, sql_cache=components.sql_cache)
     progress_bar = st.progress(0)  # Initialize progress bar
     
     def progress_callback(progress):
@@ -101,9 +230,11 @@ if st.button("Import metadata from Glue database"):
 
 
     def load_with_progress(glueSchema, database_selection):
-        glueSchema.load_embedding_from_glue_data_tables(database_selection, progress_callback)    
+        glueSchema.load_embedding_from_glue_data_tables(database_selection, progress_callback, incremental=True)
         
     if load_with_progress(glueSchema, database_selection):
         st.write("Data imported")
 else:
     pass
+
+logger.info(f"Page rendered in {time.perf_counter() - page_start:.2f}s")
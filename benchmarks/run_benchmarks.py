@@ -0,0 +1,177 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from text_sql_athena.athena_execution import AthenaQueryExecute
+from text_sql_athena.chromadb_vc_embedding import EmbeddingBedrockChroma
+from text_sql_athena.custom_logger import logger
+from text_sql_athena.glue_table_schema_loader import GlueTableSchemaLoader
+from text_sql_athena.sql_generator import RequestQueryBedrock
+from text_sql_athena.telemetry import telemetry
+from text_sql_athena.vector_embedding import EmbeddingBedrock
+from text_sql_athena.vector_store import ChromaVectorStore, NumpyVectorStore
+
+from .stubs import (CallCounter, StubAthenaClient, StubClientFactory, StubGlueClient, StubLanguageModel, StubS3Client,
+                    synthetic_tables)
+
+"""
+
+    Offline benchmarks of the text-to-SQL pipeline: Glue import, vector search, SQL generation and query execution
+    run against the local stubs over synthetic catalogs, without any AWS call.
+
+    Usage: python -m benchmarks.run_benchmarks --columns 10 1000 100000 --output benchmark.json
+
+"""
+
+# Version of the JSON layout, bumped when the compared fields change
+RESULTS_SCHEMA_VERSION = 1
+
+DATABASE_NAME = "bench"
+
+
+def measure(benchmark: str, column_count: int, counter: CallCounter, operation, iterations: int, items_per_iteration: int,
+            unit: str, track_memory=True) -> dict:
+    """
+    Runs operation(i) iterations times and reports its latency, throughput, call counts, stage metrics and peak memory.
+
+    Returns:
+    - dict: One result line of the JSON output.
+    """
+    counter.reset()
+    telemetry.reset()
+    gc.collect()
+    if track_memory:
+        tracemalloc.start()
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        operation_start = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - operation_start)
+    elapsed = time.perf_counter() - start
+    peak_memory = None
+    if track_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result = {
+        "benchmark": benchmark,
+        "columns": column_count,
+        "iterations": iterations,
+        "seconds": round(elapsed, 4),
+        "throughput": round(iterations * items_per_iteration / elapsed, 2) if elapsed else None,
+        "throughput_unit": unit,
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 3),
+        "calls": counter.snapshot(),
+        "telemetry": telemetry.snapshot(),
+        "peak_memory_mb": round(peak_memory / (1024 * 1024), 2) if peak_memory is not None else None,
+    }
+    print(f"{benchmark:>10} {column_count:>8} columns: {result['throughput']} {unit}, p50 {result['p50_ms']} ms, "
+          f"p95 {result['p95_ms']} ms, peak {result['peak_memory_mb']} MB", file=sys.stderr)
+    return result
+
+
+def run_catalog(column_count: int, args, directory: str) -> list[dict]:
+    counter = CallCounter()
+    tables = synthetic_tables(DATABASE_NAME, column_count, columns_per_table=args.columns_per_table)
+    s3_client = StubS3Client(counter)
+    athena_client = StubAthenaClient(counter, s3_client, result_rows=args.result_rows)
+    client_factory = StubClientFactory(counter, StubGlueClient(counter, tables), athena_client, s3_client)
+    sql = f"SELECT {tables[0]['StorageDescriptor']['Columns'][0]['Name']} FROM {DATABASE_NAME}.{tables[0]['Name']}"
+    language_model = StubLanguageModel(counter, embedding_dimensions=args.embedding_dimensions, embedding_latency=args.embedding_latency,
+                                       llm_latency=args.llm_latency, sql_replies=[sql])
+
+    store_path = os.path.join(directory, f"{args.vector_store}-{column_count}")
+    vector_store = NumpyVectorStore(store_path) if args.vector_store == "numpy" else ChromaVectorStore(chromadb_path=store_path)
+    ebr_chroma = EmbeddingBedrockChroma(EmbeddingBedrock(language_model), language_model, vector_store=vector_store)
+    loader = GlueTableSchemaLoader(ebr_chroma, "us-east-1", client_factory, language_model, max_workers=args.workers,
+                                   llm_requests_per_second=1e6, embedding_requests_per_second=1e6)
+    track_memory = not args.no_memory
+    results = []
+
+    documents = column_count + len(tables)
+    results.append(measure("ingest", column_count, counter, lambda i: loader.load_embedding_from_glue_data_tables(DATABASE_NAME),
+                           1, documents, "documents/s", track_memory))
+
+    query_embeddings = [language_model.embeddings.embed_query(f"Question {i} about the entities") for i in range(args.queries)]
+    results.append(measure("search", column_count, counter,
+                           lambda i: ebr_chroma.get_similarity_search(None, k=args.k, query_embedding=query_embeddings[i]),
+                           args.queries, 1, "queries/s", track_memory))
+
+    query_executor = AthenaQueryExecute(client_factory, "stub-bucket", poll_initial_delay=args.poll_delay, poll_max_delay=args.poll_delay)
+    request = RequestQueryBedrock(ebr_chroma, client_factory, "stub-bucket", language_model, query_executor=query_executor)
+    schema_context = ebr_chroma.retrieve("Question about the entities").schema_text
+    results.append(measure("generate", column_count, counter,
+                           lambda i: request.generate_sql(f"Question {i} about the entities", schema_context=schema_context),
+                           args.generations, 1, "queries/s", track_memory))
+
+    results.append(measure("execute", column_count, counter,
+                           lambda i: query_executor.execute_query(f"{sql} -- run {i}"),
+                           args.executions, args.result_rows, "rows/s", track_memory))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the text-to-SQL pipeline")
+    parser.add_argument("--columns", type=int, nargs="+", default=[10, 1000, 10000], help="Sizes of the synthetic catalogs, in columns")
+    parser.add_argument("--columns-per-table", type=int, default=50)
+    parser.add_argument("--vector-store", choices=["numpy", "chroma"], default="numpy")
+    parser.add_argument("--embedding-dimensions", type=int, default=256)
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Simulated seconds per embedding call")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Simulated seconds per model call")
+    parser.add_argument("--poll-delay", type=float, default=0.001, help="Athena polling delay, the stub needs 3 polls per execution")
+    parser.add_argument("--workers", type=int, default=8, help="Threads of the Glue import pipeline")
+    parser.add_argument("--queries", type=int, default=100, help="Vector searches per catalog")
+    parser.add_argument("--k", type=int, default=200, help="Documents returned by each vector search")
+    parser.add_argument("--generations", type=int, default=20, help="SQL generations per catalog")
+    parser.add_argument("--executions", type=int, default=5, help="Athena executions per catalog")
+    parser.add_argument("--result-rows", type=int, default=100000, help="Rows of the Athena results")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the peak memory tracking, which slows the benchmarks down")
+    parser.add_argument("--output", help="JSON output file, printed on stdout when omitted")
+    args = parser.parse_args(argv)
+
+    # The pipeline logs every table and query, only the problems are kept
+    logger.setLevel(logging.WARNING)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for column_count in args.columns:
+            results.extend(run_catalog(column_count, args, directory))
+
+    report = {
+        "schema_version": RESULTS_SCHEMA_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+import uuid
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+"""
+
+    Deterministic local stand-ins for the AWS clients and the Bedrock models, used by the benchmarks.
+    Every stub counts its calls and can simulate a service latency.
+
+"""
+
+
+class CallCounter:
+    """Thread-safe named counters shared by the stubs."""
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name: str, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(sorted(self.counts.items()))
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+
+class StubEmbeddings(Embeddings):
+    """Embeds texts with a hash, identical texts get identical vectors."""
+    def __init__(self, counter: CallCounter, dimensions=256, latency=0.0):
+        self.counter = counter
+        self.dimensions = dimensions
+        self.latency = latency
+
+    def _embed(self, text: str) -> list[float]:
+        digest = b''
+        seed = text.encode('utf8')
+        while len(digest) < self.dimensions:
+            seed = hashlib.sha256(seed).digest()
+            digest += seed
+        return [byte / 255 - 0.5 for byte in digest[:self.dimensions]]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.counter.increment("embedding_calls")
+        self.counter.increment("embedded_texts", len(texts))
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+_COLUMN_LINE = re.compile(r"^\s*- (\S+) \(", re.MULTILINE)
+
+
+class ScriptedChatModel:
+    """
+    Chat model answering from a script: column descriptions for the Glue import, and the SQL blocks of
+    sql_replies, in turn, for the SQL generation.
+    """
+    def __init__(self, counter: CallCounter, sql_replies=("SELECT 1",), latency=0.0, stream_chunk_size=16):
+        self.counter = counter
+        self.sql_replies = list(sql_replies)
+        self.latency = latency
+        self.stream_chunk_size = stream_chunk_size
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def _prompt(self, messages) -> str:
+        return "\n".join(message[1] if isinstance(message, tuple) else str(message.content) for message in messages)
+
+    def _reply(self, messages) -> str:
+        self.counter.increment("llm_calls")
+        time.sleep(self.latency)
+        prompt = self._prompt(messages)
+        if "JSON object whose keys are the column names" in prompt:
+            return json.dumps({column: f"Description of {column}" for column in _COLUMN_LINE.findall(prompt)})
+        if "Column Name:" in prompt:
+            return "Description of the column"
+        with self.lock:
+            sql = self.sql_replies[self.position % len(self.sql_replies)]
+            self.position += 1
+        return f"```sql\n{sql}\n```"
+
+    def invoke(self, messages, **kwargs):
+        reply = self._reply(messages)
+        # Roughly 4 characters per token, like the Bedrock models
+        input_tokens, output_tokens = len(self._prompt(messages)) // 4, len(reply) // 4
+        return AIMessage(content=reply, usage_metadata={"input_tokens": input_tokens, "output_tokens": output_tokens,
+                                                        "total_tokens": input_tokens + output_tokens})
+
+    async def ainvoke(self, messages, **kwargs):
+        return self.invoke(messages, **kwargs)
+
+    def stream(self, messages, **kwargs):
+        text = self._reply(messages)
+        for start in range(0, len(text), self.stream_chunk_size):
+            yield AIMessageChunk(content=text[start:start + self.stream_chunk_size])
+
+    async def astream(self, messages, **kwargs):
+        for chunk in self.stream(messages, **kwargs):
+            yield chunk
+
+
+class StubLanguageModel:
+    """Same attributes as LanguageModel, backed by the stubs."""
+    def __init__(self, counter: CallCounter, embedding_dimensions=256, embedding_latency=0.0, llm_latency=0.0, sql_replies=("SELECT 1",)):
+        self.embed_model_id = "stub-embeddings"
+        self.llm_model_id = "stub-llm"
+        self.embeddings = StubEmbeddings(counter, embedding_dimensions, embedding_latency)
+        self.llm = ScriptedChatModel(counter, sql_replies, llm_latency)
+        self.embedding_cache = None
+
+
+class _Body(io.BytesIO):
+    """Streaming body of a get_object response."""
+
+
+class StubS3Client:
+    def __init__(self, counter: CallCounter):
+        self.counter = counter
+        self.objects = {} # (bucket, key) -> bytes
+
+    def put(self, uri: str, data: bytes):
+        bucket, _, key = uri.removeprefix("s3://").partition("/")
+        self.objects[(bucket, key)] = data
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.counter.increment("s3_get_object")
+        data = self.objects[(Bucket, Key)]
+        response = {}
+        if Range:
+            start, _, end = Range.removeprefix("bytes=").partition("-")
+            end = min(int(end), len(data) - 1)
+            response["ContentRange"] = f"bytes {start}-{end}/{len(data)}"
+            data = data[int(start):end + 1]
+        response["Body"] = _Body(data)
+        return response
+
+    def get_paginator(self, operation_name):
+        stub = self
+
+        class ListObjectsPaginator:
+            def paginate(self, Bucket, Prefix=""):
+                stub.counter.increment("s3_list_objects")
+                yield {"Contents": [{"Key": key, "Size": len(data)} for (bucket, key), data in stub.objects.items()
+                                    if bucket == Bucket and key.startswith(Prefix)]}
+        return ListObjectsPaginator()
+
+
+class StubAthenaClient:
+    """
+    Athena stand-in: executions go through QUEUED and RUNNING for a number of polls before succeeding,
+    data queries write a CSV result of result_rows rows to the S3 stub.
+    """
+    def __init__(self, counter: CallCounter, s3_client: StubS3Client, result_rows=1000, queued_polls=1, running_polls=2):
+        self.counter = counter
+        self.s3_client = s3_client
+        self.result_rows = result_rows
+        self.queued_polls = queued_polls
+        self.running_polls = running_polls
+        self.executions = {}
+        self.lock = threading.Lock()
+        # Built once, outside of the measured executions
+        lines = ["id,host,os,cpu,detected_at"]
+        lines.extend(f"{i},host-{i % 997},{'Linux' if i % 3 else 'Windows'},{i % 100 / 100},2024-01-01 00:00:{i % 60:02d}"
+                     for i in range(result_rows))
+        self.result_csv = ("\n".join(lines) + "\n").encode('utf8')
+
+    def start_query_execution(self, QueryString, QueryExecutionContext=None, ResultConfiguration=None, WorkGroup=None, ResultReuseConfiguration=None):
+        self.counter.increment("athena_start_query_execution")
+        execution_id = str(uuid.uuid4())
+        location = f"{(ResultConfiguration or {}).get('OutputLocation', 's3://stub-bucket/').rstrip('/')}/{execution_id}.csv"
+        explain = QueryString.lstrip().upper().startswith("EXPLAIN")
+        if not explain:
+            self.s3_client.put(location, self.result_csv)
+        with self.lock:
+            self.executions[execution_id] = {"query": QueryString, "location": location, "polls": 0, "explain": explain, "stopped": False}
+        return {"QueryExecutionId": execution_id}
+
+    def get_query_execution(self, QueryExecutionId):
+        self.counter.increment("athena_get_query_execution")
+        with self.lock:
+            execution = self.executions[QueryExecutionId]
+            execution["polls"] += 1
+            polls = execution["polls"]
+        if execution["stopped"]:
+            state = "CANCELLED"
+        elif polls <= self.queued_polls:
+            state = "QUEUED"
+        elif polls <= self.queued_polls + self.running_polls:
+            state = "RUNNING"
+        else:
+            state = "SUCCEEDED"
+        return {"QueryExecution": {
+            "QueryExecutionId": QueryExecutionId,
+            "Query": execution["query"],
+            "Status": {"State": state},
+            "ResultConfiguration": {"OutputLocation": execution["location"]},
+        }}
+
+    def get_query_results(self, QueryExecutionId, MaxResults=1000, NextToken=None):
+        self.counter.increment("athena_get_query_results")
+        execution = self.executions[QueryExecutionId]
+        if execution["explain"]:
+            rows = [["Query Plan"], ["Fragment 0 [SINGLE]"]]
+        elif self.result_rows < MaxResults:
+            rows = [line.split(",") for line in self.result_csv.decode('utf8').splitlines()]
+        else:
+            # The first page of a large result, only its column metadata is used
+            header = self.result_csv.decode('utf8').partition("\n")[0].split(",")
+            return {"ResultSet": {"Rows": [], "ResultSetMetadata": {"ColumnInfo": [{"Name": name} for name in header]}}, "NextToken": "next"}
+        return {"ResultSet": {
+            "Rows": [{"Data": [{"VarCharValue": value} for value in row]} for row in rows],
+            "ResultSetMetadata": {"ColumnInfo": [{"Name": name} for name in rows[0]]},
+        }}
+
+    def stop_query_execution(self, QueryExecutionId):
+        self.counter.increment("athena_stop_query_execution")
+        with self.lock:
+            self.executions[QueryExecutionId]["stopped"] = True
+
+
+def synthetic_tables(database_name: str, column_count: int, columns_per_table=50, commented_ratio=0.5) -> list:
+    """Glue tables totalling column_count columns, a part of them without comment to exercise the enrichment."""
+    tables = []
+    for table_index in range((column_count + columns_per_table - 1) // columns_per_table):
+        count = min(columns_per_table, column_count - table_index * columns_per_table)
+        columns = []
+        for column_index in range(count):
+            column = {"Name": f"col_{table_index}_{column_index}", "Type": ("string", "bigint", "double", "timestamp")[column_index % 4]}
+            if column_index < count * commented_ratio:
+                column["Comment"] = f"Attribute {column_index} of entity {table_index}"
+            columns.append(column)
+        tables.append({"DatabaseName": database_name, "Name": f"table_{table_index}", "Description": f"Entity {table_index}",
+                       "VersionId": "1", "StorageDescriptor": {"Columns": columns}})
+    return tables
+
+
+class StubGlueClient:
+    def __init__(self, counter: CallCounter, tables: list, page_size=100):
+        self.counter = counter
+        self.tables = tables
+        self.page_size = page_size
+
+    def get_database(self, Name):
+        self.counter.increment("glue_get_database")
+        return {"Database": {"Name": Name, "Parameters": {"description": f"Synthetic database {Name}"}}}
+
+    def get_databases(self, NextToken=None):
+        self.counter.increment("glue_get_databases")
+        return {"DatabaseList": [{"Name": name} for name in sorted({table["DatabaseName"] for table in self.tables})]}
+
+    def get_tables(self, DatabaseName, NextToken=None):
+        self.counter.increment("glue_get_tables")
+        start = int(NextToken or 0)
+        # Copies, like the real client, the loader updates the returned tables
+        page = json.loads(json.dumps([table for table in self.tables if table["DatabaseName"] == DatabaseName][start:start + self.page_size]))
+        response = {"TableList": page}
+        if start + self.page_size < sum(1 for table in self.tables if table["DatabaseName"] == DatabaseName):
+            response["NextToken"] = str(start + self.page_size)
+        return response
+
+
+class StubClientFactory:
+    """Drop-in replacement of AwsClientFactory returning the stubs."""
+    def __init__(self, counter: CallCounter, glue_client=None, athena_client=None, s3_client=None):
+        self.counter = counter
+        self.glue_client = glue_client
+        self.athena_client = athena_client
+        self.s3_client = s3_client
+
+    def warm_up(self, services=()):
+        return self
+
+    def createBedrockClient(self):
+        return None
+
+    def createBedrockRuntimeClient(self):
+        return None
+
+    def createAthenaClient(self):
+        return self.athena_client
+
+    def createS3Client(self):
+        return self.s3_client
+
+    def createGlueClient(self):
+        return self.glue_client
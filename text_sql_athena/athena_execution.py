@@ -1,75 +1,577 @@
 # sys.path.append("/home/ec2-user/SageMaker/llm_bedrock_v0/")
 from .custom_logger import logger
+from .athena_scheduler import EXPLAIN_PRIORITY, QUERY_PRIORITY, AthenaExecutionScheduler, ExecutionCancelled
+from .rate_limiter import RateLimiter, call_with_throttling_retry
+from .telemetry import telemetry
 from text_sql_athena.aws_client_factory import AwsClientFactory
+import asyncio
+import random
+import re
+import threading
 import time
+import uuid
+from collections import OrderedDict
 import pandas as pd
-import io
+
+
+# Terminal states reported by Athena, plus a local state for queries that outlived their deadline
+QUERY_SUCCEEDED = 'SUCCEEDED'
+QUERY_FAILED = 'FAILED'
+QUERY_CANCELLED = 'CANCELLED'
+QUERY_TIMED_OUT = 'TIMED_OUT'
+TERMINAL_STATES = (QUERY_SUCCEEDED, QUERY_FAILED, QUERY_CANCELLED)
+# Reason of the executions stopped because their caller set its cancel event
+CANCELLED_BY_CALLER = "Cancelled by the caller"
+
+
+class QueryExecutionResult:
+    """Outcome of waiting for an Athena query execution."""
+    def __init__(self, execution_id: str, state: str, reason: str = None, query_execution: dict = None):
+        self.execution_id = execution_id
+        self.state = state
+        self.reason = reason
+        self.query_execution = query_execution or {}
+
+    @property
+    def succeeded(self) -> bool:
+        return self.state == QUERY_SUCCEEDED
+
+    def __repr__(self):
+        return f"QueryExecutionResult(execution_id={self.execution_id!r}, state={self.state!r}, reason={self.reason!r})"
+
+
+class AthenaQueryError(Exception):
+    """Raised when an Athena query does not reach the SUCCEEDED state."""
+    def __init__(self, result: QueryExecutionResult):
+        super().__init__(f"Athena query {result.execution_id} {result.state}: {result.reason}")
+        self.result = result
+
+
+def backoff_delays(initial_delay: float, max_delay: float, multiplier: float = 2.0):
+    """Yields exponentially growing polling delays with jitter, capped at max_delay."""
+    delay = initial_delay
+    while True:
+        # Equal jitter: keep half of the delay, randomize the other half
+        yield delay / 2 + random.uniform(0, delay / 2)
+        delay = min(delay * multiplier, max_delay)
+
+
+# Maximum number of rows returned by a single get_query_results call
+RESULT_PAGE_SIZE = 1000
+
+
+def _record_execution(query_execution: dict, state: str):
+    """Counts a finished execution and the bytes it scanned."""
+    telemetry.increment("athena_queries_total", state=state)
+    scanned_bytes = query_execution.get('Statistics', {}).get('DataScannedInBytes')
+    if scanned_bytes:
+        telemetry.increment("athena_data_scanned_bytes_total", scanned_bytes)
+
+
+def _split_s3_uri(uri: str):
+    """Splits s3://bucket/key into (bucket, key)."""
+    bucket, _, key = uri.removeprefix("s3://").partition("/")
+    return bucket, key
+
+
+def _result_set_to_dataframe(result_set: dict):
+    """Converts a get_query_results ResultSet, whose first row is the header, into a DataFrame."""
+    columns = [column['Name'] for column in result_set['ResultSetMetadata']['ColumnInfo']]
+    rows = [[value.get('VarCharValue') for value in row['Data']] for row in result_set['Rows'][1:]]
+    df = pd.DataFrame(rows, columns=columns)
+    # Values come back as strings, let pandas infer the types like read_csv does
+    for column in df.columns:
+        try:
+            df[column] = pd.to_numeric(df[column])
+        except (ValueError, TypeError):
+            pass
+    return df
+
+
+def _is_truncated(get_object_response: dict) -> bool:
+    """Tells if a ranged get_object response stops before the end of the object."""
+    content_range = get_object_response.get('ContentRange')
+    if not content_range:
+        return False
+    # Format is "bytes <start>-<end>/<total>"
+    byte_range, _, total = content_range.removeprefix("bytes ").partition("/")
+    end = int(byte_range.partition("-")[2])
+    return total != '*' and end + 1 < int(total)
+
+
+class _CompleteLinesReader:
+    """File-like wrapper dropping the trailing partial line of a truncated (ranged) S3 body."""
+    def __init__(self, body, read_size=1024 * 1024):
+        self.body = body
+        self.read_size = read_size
+        self.pending = b''
+        self.exhausted = False
+
+    def read(self, size=-1):
+        size = self.read_size if size is None or size < 0 else size
+        while not self.exhausted and len(self.pending) < size:
+            data = self.body.read(self.read_size)
+            if not data:
+                self.exhausted = True
+                # Keep only complete lines, the last one was cut by the byte cap
+                self.pending = self.pending[:self.pending.rfind(b'\n') + 1]
+            self.pending += data
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+# Maximum age of a reused result accepted by Athena, 7 days
+MAX_RESULT_REUSE_MINUTES = 7 * 24 * 60
+
+_LITERAL_OR_SPACES = re.compile(r"('(?:[^']|'')*')|\s+")
+
+
+def normalize_sql(query_string: str) -> str:
+    """Collapses the whitespace outside of string literals and drops the trailing semicolons, so equivalent statements share a cache key."""
+    normalized = _LITERAL_OR_SPACES.sub(lambda match: match.group(1) or ' ', query_string)
+    return normalized.strip().rstrip(';').strip()
+
+
+# Formats of the query results: CSV files written by Athena, or Parquet files written by UNLOAD
+CSV_FORMAT = 'csv'
+PARQUET_FORMAT = 'parquet'
+
+_SELECT_STATEMENT = re.compile(r"^\s*(SELECT|WITH)\b", re.IGNORECASE)
+_UNLOAD_TARGET = re.compile(r"\n\) TO '([^']+)' WITH \(format = 'PARQUET'\)$")
+
+
+def unload_statement(query_string: str, location: str) -> str:
+    """Wraps a query in an UNLOAD writing its result as Parquet files under location, which must be empty."""
+    # The query is kept on its own lines, a trailing comment cannot swallow the closing parenthesis
+    return f"UNLOAD (\n{query_string.strip().rstrip(';')}\n) TO '{location}' WITH (format = 'PARQUET')"
+
+
+def _unload_location(result) -> str:
+    """Returns the Parquet location of an execution started by unload_statement, None for the other executions."""
+    match = _UNLOAD_TARGET.search(result.query_execution.get('Query', ''))
+    return match.group(1) if match else None
+
+
+class ExecutionIdCache:
+    """Thread-safe cache of the ids of the succeeded executions, their result files are read again instead of re-running the query."""
+    def __init__(self, max_age_seconds=3600, max_entries=1000):
+        self.max_age_seconds = max_age_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (execution id, completion time)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.max_age_seconds:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, execution_id: str):
+        with self.lock:
+            self.entries[key] = (execution_id, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
 
 
 class AthenaQueryExecute:
-    def __init__(self, clientFactory: AwsClientFactory, glue_databucket_name='ATHENA-OUTPUT-BUCKET'):
+    def __init__(self, clientFactory: AwsClientFactory, glue_databucket_name='ATHENA-OUTPUT-BUCKET',
+                 query_timeout=600, syntax_check_timeout=60, poll_initial_delay=0.2, poll_max_delay=5.0,
+                 workgroup: str = None, output_location: str = None, database: str = None,
+                 result_reuse_minutes: int = None, execution_cache: ExecutionIdCache = None, result_format=CSV_FORMAT,
+                 rate_limiter: RateLimiter = None, scheduler: AthenaExecutionScheduler = None):
+        """
+        Args:
+        - glue_databucket_name (str): Bucket receiving the results, under the athena_output/ and athena_query_output/ prefixes.
+          None leaves the output location to the workgroup configuration.
+        - workgroup (str): Athena workgroup of the executions, the primary workgroup when None.
+        - output_location (str): S3 prefix of the results, e.g. s3://bucket/prefix/, takes precedence over glue_databucket_name.
+        - database (str): Default database of the unqualified table names.
+        - result_reuse_minutes (int): Lets Athena return the result of an identical query run within this age, without scanning data again.
+          Not applied to the SELECT queries in Parquet mode: each UNLOAD writes to a new location, Athena never reuses it.
+        - execution_cache (ExecutionIdCache): Local cache of the executions, shared between instances. Identical queries
+          read the previous result file without starting an execution at all.
+        - result_format (str): 'parquet' runs the SELECT queries through UNLOAD and reads the typed Parquet files with PyArrow,
+          the CSV result is used for the other statements, when UNLOAD fails or when pyarrow is not installed.
+          Athena result reuse is then lost for the SELECT queries, only execution_cache avoids running them again.
+        - rate_limiter (RateLimiter): Limits the executions started per second, e.g. by a batch. Throttled starts are retried.
+        - scheduler (AthenaExecutionScheduler): Process-wide admission control shared by the instances: caps the running
+          executions, runs the EXPLAINs first and identical in-flight queries once.
+        """
         self.glue_databucket_name=glue_databucket_name
         self.athena_client = clientFactory.createAthenaClient()
         self.s3_client = clientFactory.createS3Client()
+        self.query_timeout = query_timeout
+        self.syntax_check_timeout = syntax_check_timeout
+        self.poll_initial_delay = poll_initial_delay
+        self.poll_max_delay = poll_max_delay
+        self.workgroup = workgroup
+        if output_location is None and glue_databucket_name:
+            output_location = f"s3://{glue_databucket_name}/"
+        if output_location and not output_location.endswith('/'):
+            output_location += '/'
+        self.output_location = output_location
+        self.database = database
+        self.result_reuse_minutes = min(result_reuse_minutes, MAX_RESULT_REUSE_MINUTES) if result_reuse_minutes else None
+        self.execution_cache = execution_cache
+        self.rate_limiter = rate_limiter
+        self.scheduler = scheduler
+        if result_format == PARQUET_FORMAT:
+            try:
+                import pyarrow.parquet # noqa: F401
+            except ImportError:
+                logger.warning("pyarrow is not installed, the query results are read as CSV")
+                result_format = CSV_FORMAT
+        self.result_format = result_format
+        if self.result_format == PARQUET_FORMAT and self.result_reuse_minutes:
+            logger.warning("Athena result reuse does not apply to the UNLOAD of the Parquet mode, use an execution cache instead")
+
+    def wait_for_execution(self, execution_id: str, timeout: float = None, cancel_event: threading.Event = None) -> QueryExecutionResult:
+        """
+        Polls get_query_execution with exponential backoff until the query reaches a terminal state.
+
+        Args:
+        - execution_id (str): Athena query execution id.
+        - timeout (float): Overall deadline in seconds, defaults to query_timeout. The query is stopped when it is exceeded.
+        - cancel_event (threading.Event): When set by another thread, the query is stopped and reported as CANCELLED.
+
+        Returns:
+        - QueryExecutionResult: state is one of SUCCEEDED, FAILED, CANCELLED or TIMED_OUT.
+        """
+        timeout = self.query_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        delays = backoff_delays(self.poll_initial_delay, self.poll_max_delay)
+        while True:
+            result = self._check_execution(execution_id, deadline, timeout)
+            if result is not None:
+                return result
+            delay = max(0, min(next(delays), deadline - time.monotonic()))
+            if cancel_event is None:
+                time.sleep(delay)
+            elif cancel_event.wait(delay):
+                logger.info(f"Query {execution_id} no longer needed, cancelling it")
+                self.cancel_query(execution_id)
+                return QueryExecutionResult(execution_id, QUERY_CANCELLED, CANCELLED_BY_CALLER)
+
+    async def await_execution(self, execution_id: str, timeout: float = None) -> QueryExecutionResult:
+        """Same as wait_for_execution, but waits between the polls without blocking the event loop."""
+        timeout = self.query_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        delays = backoff_delays(self.poll_initial_delay, self.poll_max_delay)
+        while True:
+            result = await asyncio.to_thread(self._check_execution, execution_id, deadline, timeout)
+            if result is not None:
+                return result
+            await asyncio.sleep(max(0, min(next(delays), deadline - time.monotonic())))
+
+    def _check_execution(self, execution_id: str, deadline: float, timeout: float):
+        """Polls the execution once, returns its result when it is over or past the deadline, None otherwise."""
+        response = self.athena_client.get_query_execution(QueryExecutionId=execution_id)
+        query_execution = response['QueryExecution']
+        status = query_execution['Status']
+        state = status['State']
+        if state in TERMINAL_STATES:
+            logger.info(f"Query {execution_id} finished with state {state}")
+            _record_execution(query_execution, state)
+            return QueryExecutionResult(execution_id, state, status.get('StateChangeReason'), query_execution)
+
+        if time.monotonic() >= deadline:
+            logger.warning(f"Query {execution_id} still {state} after {timeout} seconds, cancelling it")
+            self.cancel_query(execution_id)
+            _record_execution(query_execution, QUERY_TIMED_OUT)
+            return QueryExecutionResult(execution_id, QUERY_TIMED_OUT,
+                                        f"Query did not complete within {timeout} seconds", query_execution)
+        return None
+
+    def cancel_query(self, execution_id: str):
+        try:
+            self.athena_client.stop_query_execution(QueryExecutionId=execution_id)
+            logger.info(f"Query {execution_id} cancelled")
+        except Exception as e:
+            logger.error(f"Unable to cancel query {execution_id}: {e}")
     
-    def execute_query(self, query_string):
-        # logger.info("Inside execute query", query_string)
-        result_folder='athena_output'
-        result_config = {"OutputLocation": f"s3://{self.glue_databucket_name}/{result_folder}"}
-        query_execution_context = {
-            "Catalog": "AwsDataCatalog",
+    def execute_query(self, query_string, max_rows=None, max_bytes=None, columns: list[str] = None):
+        """Executes the query and loads the whole result, bounded by max_rows / max_bytes, as a DataFrame."""
+        with telemetry.span("execute_query"):
+            chunks = list(self.iter_query_results(query_string, max_rows=max_rows, max_bytes=max_bytes, columns=columns))
+        if not chunks:
+            return pd.DataFrame()
+        return pd.concat(chunks, ignore_index=True)
+
+    async def aexecute_query(self, query_string, max_rows=None, max_bytes=None, columns: list[str] = None):
+        """Async version of execute_query: the AWS calls run in the default executor and the polling does not block the event loop."""
+        result = await asyncio.to_thread(self._cached_execution, query_string)
+        if result is None:
+            result = await self._arun_query(query_string)
+
+        def load():
+            chunks = list(self._iter_results(result, max_rows=max_rows, max_bytes=max_bytes, columns=columns))
+            return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+        return await asyncio.to_thread(load)
+
+    def iter_query_results(self, query_string, chunksize=10000, max_rows=None, max_bytes=None, columns: list[str] = None):
+        """
+        Executes the query and yields its result incrementally as DataFrames.
+
+        Results that fit in a single get_query_results page are returned from the API directly,
+        larger ones are streamed from the S3 result file and parsed chunksize rows at a time.
+        In Parquet mode the UNLOAD files are read part by part with PyArrow instead.
+
+        Args:
+        - query_string (str): Sql query to execute.
+        - chunksize (int): Number of rows per yielded DataFrame for S3 results.
+        - max_rows (int): Stop after this many rows.
+        - max_bytes (int): Read at most this many bytes of the S3 result file. Parquet parts are read whole,
+          the reading stops before the part exceeding the limit, the first part is always read.
+        - columns (list): Loads only these columns, the other Parquet columns are not even read.
+
+        Returns:
+        - Iterator[DataFrame]: Result batches, peak memory is bounded by chunksize.
+        """
+        result = self._run_query(query_string)
+        yield from self._iter_results(result, chunksize, max_rows, max_bytes, columns)
+
+    def _iter_results(self, result: QueryExecutionResult, chunksize=10000, max_rows=None, max_bytes=None, columns=None):
+        execution_id = result.execution_id
+        location = _unload_location(result)
+        if location is not None:
+            yield from self._iter_parquet_results(location, chunksize, max_rows, max_bytes, columns)
+            return
+
+        # The first page is enough for small results and saves a S3 round-trip
+        page = self.athena_client.get_query_results(QueryExecutionId=execution_id, MaxResults=RESULT_PAGE_SIZE)
+        if 'NextToken' not in page:
+            df = _result_set_to_dataframe(page['ResultSet'])
+            if columns is not None:
+                df = df[columns]
+            yield df.head(max_rows) if max_rows is not None else df
+            return
+
+        header = [column['Name'] for column in page['ResultSet']['ResultSetMetadata']['ColumnInfo']]
+        bucket, key = _split_s3_uri(result.query_execution['ResultConfiguration']['OutputLocation'])
+        logger.info(f'Streaming result file s3://{bucket}/{key}')
+        get_object_args = {"Bucket": bucket, "Key": key}
+        if max_bytes is not None:
+            get_object_args["Range"] = f"bytes=0-{max_bytes - 1}"
+        obj = self.s3_client.get_object(**get_object_args)
+        body = obj['Body']
+        try:
+            reader = _CompleteLinesReader(body) if _is_truncated(obj) else body
+            try:
+                chunks = pd.read_csv(reader, encoding='utf8', chunksize=chunksize, usecols=columns)
+            except pd.errors.EmptyDataError:
+                # max_bytes stops before the end of the header line, no row is complete
+                yield pd.DataFrame(columns=columns if columns is not None else header)
+                return
+            rows = 0
+            for df in chunks:
+                if max_rows is not None and rows + len(df) >= max_rows:
+                    yield df.head(max_rows - rows)
+                    return
+                rows += len(df)
+                yield df
+        finally:
+            body.close()
+
+    def _iter_parquet_results(self, location: str, chunksize, max_rows, max_bytes, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        bucket, prefix = _split_s3_uri(location)
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        parts = [part for page in paginator.paginate(Bucket=bucket, Prefix=prefix) for part in page.get('Contents', []) if part['Size'] > 0]
+        logger.info(f'Reading {len(parts)} Parquet parts from {location}')
+        rows = 0
+        read_bytes = 0
+        for part in sorted(parts, key=lambda part: part['Key']):
+            if max_bytes is not None and read_bytes and read_bytes + part['Size'] > max_bytes:
+                return
+            data = self.s3_client.get_object(Bucket=bucket, Key=part['Key'])['Body'].read()
+            read_bytes += len(data)
+            parquet_file = pq.ParquetFile(pa.BufferReader(data))
+            for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+                # The Arrow buffers are released while converted, numeric columns without nulls are not copied
+                df = pa.Table.from_batches([batch]).to_pandas(split_blocks=True, self_destruct=True)
+                if max_rows is not None and rows + len(df) >= max_rows:
+                    yield df.head(max_rows - rows)
+                    return
+                rows += len(df)
+                yield df
+
+    def _unload_target(self, query_string):
+        """Returns an empty location for the UNLOAD of a query, None when the query must be run as CSV."""
+        if self.result_format != PARQUET_FORMAT or not self.output_location or not _SELECT_STATEMENT.match(query_string):
+            return None
+        return f"{self.output_location}athena_unload/{uuid.uuid4()}/"
+
+    def _run_query(self, query_string) -> QueryExecutionResult:
+        result = self._cached_execution(query_string)
+        if result is not None:
+            return result
+        with telemetry.span("athena_query"):
+            if self.scheduler is not None:
+                return self.scheduler.coalesce(self._execution_key(query_string), lambda: self._run_new_query(query_string))
+            return self._run_new_query(query_string)
+
+    def _run_new_query(self, query_string) -> QueryExecutionResult:
+        location = self._unload_target(query_string)
+        if location is not None:
+            result = self._execute(unload_statement(query_string, location), 'athena_output')
+            if result.succeeded:
+                self._remember_execution(query_string, result)
+                return result
+            logger.warning(f"UNLOAD failed ({result.reason}), running the query with a CSV result")
+        result = self._execute(query_string, 'athena_output', reuse_results=True)
+        if not result.succeeded:
+            raise AthenaQueryError(result)
+        self._remember_execution(query_string, result)
+        return result
+
+    def _execute(self, query_string, result_folder, reuse_results=False, timeout=None, cancel_event: threading.Event = None,
+                 priority=QUERY_PRIORITY) -> QueryExecutionResult:
+        """Starts an execution and waits for its end, once the scheduler, if any, grants a slot."""
+        def run():
+            execution_id = self._start_query(query_string, result_folder, reuse_results)
+            return self.wait_for_execution(execution_id, timeout=timeout, cancel_event=cancel_event)
+        if self.scheduler is None:
+            return run()
+        return self.scheduler.run(run, priority=priority, cancel_event=cancel_event)
+
+    async def _arun_query(self, query_string) -> QueryExecutionResult:
+        if self.scheduler is not None:
+            # Waiting for a slot blocks, it happens outside of the event loop
+            return await asyncio.to_thread(self._run_query, query_string)
+        with telemetry.span("athena_query"):
+            return await self._arun_new_query(query_string)
+
+    async def _arun_new_query(self, query_string) -> QueryExecutionResult:
+        location = self._unload_target(query_string)
+        if location is not None:
+            execution_id = await asyncio.to_thread(self._start_query, unload_statement(query_string, location), 'athena_output')
+            result = await self.await_execution(execution_id)
+            if result.succeeded:
+                self._remember_execution(query_string, result)
+                return result
+            logger.warning(f"UNLOAD failed ({result.reason}), running the query with a CSV result")
+        execution_id = await asyncio.to_thread(self._start_query, query_string, 'athena_output', True)
+        result = await self.await_execution(execution_id)
+        if not result.succeeded:
+            raise AthenaQueryError(result)
+        self._remember_execution(query_string, result)
+        return result
+
+    def _execution_key(self, query_string):
+        return (normalize_sql(query_string), self.database, self.workgroup, self.result_format)
+
+    def _cached_execution(self, query_string):
+        """Returns the result of a previous execution of the same query still available, or None."""
+        if self.execution_cache is None:
+            return None
+        key = self._execution_key(query_string)
+        execution_id = self.execution_cache.get(key)
+        if execution_id is None:
+            telemetry.record_cache("athena_execution", hits=0, misses=1)
+            return None
+        try:
+            query_execution = self.athena_client.get_query_execution(QueryExecutionId=execution_id)['QueryExecution']
+        except Exception as e:
+            logger.warning(f"Cached execution {execution_id} not available anymore: {e}")
+            self.execution_cache.discard(key)
+            telemetry.record_cache("athena_execution", hits=0, misses=1)
+            return None
+        if query_execution['Status']['State'] != QUERY_SUCCEEDED:
+            self.execution_cache.discard(key)
+            telemetry.record_cache("athena_execution", hits=0, misses=1)
+            return None
+        logger.info(f"Reusing the result of execution {execution_id}")
+        telemetry.record_cache("athena_execution", hits=1)
+        return QueryExecutionResult(execution_id, QUERY_SUCCEEDED, None, query_execution)
+
+    def _remember_execution(self, query_string, result: QueryExecutionResult):
+        reuse_information = result.query_execution.get('Statistics', {}).get('ResultReuseInformation', {})
+        if reuse_information.get('ReusedPreviousResult'):
+            logger.info(f"Athena reused a previous result for execution {result.execution_id}")
+            telemetry.record_cache("athena_result_reuse", hits=1)
+        if self.execution_cache is not None:
+            self.execution_cache.put(self._execution_key(query_string), result.execution_id)
+
+    def _start_query(self, query_string, result_folder, reuse_results=False) -> str:
+        request = {
+            "QueryString": query_string,
+            "QueryExecutionContext": {
+                "Catalog": "AwsDataCatalog",
+            },
         }
+        if self.database:
+            request["QueryExecutionContext"]["Database"] = self.database
+        if self.output_location:
+            request["ResultConfiguration"] = {"OutputLocation": f"{self.output_location}{result_folder}"}
+        if self.workgroup:
+            request["WorkGroup"] = self.workgroup
+        if reuse_results and self.result_reuse_minutes:
+            request["ResultReuseConfiguration"] = {
+                "ResultReuseByAgeConfiguration": {"Enabled": True, "MaxAgeInMinutes": self.result_reuse_minutes}
+            }
         logger.info(f"Executing: {query_string}")
-        query_execution = self.athena_client.start_query_execution(
-            QueryString=query_string,
-            ResultConfiguration=result_config,
-            QueryExecutionContext=query_execution_context,
-        )
-        execution_id = query_execution["QueryExecutionId"]
-        time.sleep(120)
-
-        #self.wait_for_execution(execution_id)
-        file_name = f"{result_folder}/{execution_id}.csv"
-        logger.info(f'checking for file :{file_name}')
-        local_file_name = f"./tmp/{file_name}"
-
-        logger.info(f"Calling download fine with params {local_file_name}, {result_config}")
-        obj = self.s3_client.get_object(Bucket= self.glue_databucket_name , Key = file_name)
-        df = pd.read_csv(io.BytesIO(obj['Body'].read()), encoding='utf8')
-        # logger.info(df.head())
-        return df
+        query_execution = call_with_throttling_retry(self.athena_client.start_query_execution, rate_limiter=self.rate_limiter,
+                                                     on_throttled=self.scheduler.throttled if self.scheduler else None, **request)
+        return query_execution["QueryExecutionId"]
         
-    def syntax_checker(self,query_string):
-        logger.info("Inside syntax_checker", query_string)
-        query_result_folder='athena_query_output/'
-        query_config = {"OutputLocation": f"s3://{self.glue_databucket_name}/{query_result_folder}"}
-        query_execution_context = {
-            "Catalog": "AwsDataCatalog",
-        }
-        query_string="Explain  "+query_string
-        logger.info(f"Executing: {query_string}")
+    def syntax_checker(self,query_string, cancel_event: threading.Event = None):
+        logger.info(f"Inside syntax_checker {query_string}")
         try:
             logger.info(" I am checking the syntax here")
-            query_execution = self.athena_client.start_query_execution(
-                QueryString=query_string,
-                ResultConfiguration=query_config,
-                QueryExecutionContext=query_execution_context,
-            )
-            execution_id = query_execution["QueryExecutionId"]
+            def explain():
+                return self._execute("Explain  "+query_string, 'athena_query_output/', timeout=self.syntax_check_timeout,
+                                     cancel_event=cancel_event, priority=EXPLAIN_PRIORITY)
+            if self.scheduler is not None and cancel_event is None:
+                # Only the EXPLAINs no caller can cancel are shared, a cancellation would reach every caller waiting for it
+                try:
+                    result = self.scheduler.coalesce(("EXPLAIN",) + self._execution_key(query_string), explain)
+                except ExecutionCancelled:
+                    result = None
+                if result is None or result.reason == CANCELLED_BY_CALLER:
+                    # The shared execution was cancelled by another caller, this one still needs the answer
+                    result = explain()
+            else:
+                result = explain()
+            return self._syntax_check_message(result)
+        except Exception as e:
+            logger.error("Error in exception")
+            msg = str(e)
+            logger.error(msg)
+            return msg
+
+    async def asyntax_checker(self, query_string):
+        """Async version of syntax_checker."""
+        if self.scheduler is not None:
+            return await asyncio.to_thread(self.syntax_checker, query_string)
+        logger.info(f"Inside asyntax_checker {query_string}")
+        try:
+            execution_id = await asyncio.to_thread(self._start_query, "Explain  "+query_string, 'athena_query_output/')
             logger.info(f"execution_id: {execution_id}")
-            time.sleep(3)
-            results = self.athena_client.get_query_execution(QueryExecutionId=execution_id)
-            # logger.info(f"results: {results}")
-            status=results['QueryExecution']['Status']
-            logger.info("Status :",status)
-            if status['State']=='SUCCEEDED':
-                return "Passed"
-            else:  
-                logger.info(results['QueryExecution']['Status']['StateChangeReason'])
-                errmsg=results['QueryExecution']['Status']['StateChangeReason']
-                return errmsg
-            # return results
+            result = await self.await_execution(execution_id, timeout=self.syntax_check_timeout)
+            return self._syntax_check_message(result)
         except Exception as e:
             logger.error("Error in exception")
             msg = str(e)
-            logger.error(msg)
\ No newline at end of file
+            logger.error(msg)
+            return msg
+
+    def _syntax_check_message(self, result: QueryExecutionResult) -> str:
+        logger.info(f"Status : {result.state}")
+        if result.succeeded:
+            return "Passed"
+        else:  
+            logger.info(result.reason)
+            errmsg=result.reason
+            return errmsg
@@ -0,0 +1,149 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+from .custom_logger import logger
+from .telemetry import telemetry
+
+"""
+
+    Process-wide admission control of the Athena executions.
+    Every session submits its EXPLAINs and queries to the same scheduler, which keeps the number of running
+    executions under the active query quota, serves the EXPLAINs first and runs identical in-flight queries once.
+
+"""
+
+# Lower values are admitted first: the EXPLAINs are short and a user is waiting for the generated SQL
+EXPLAIN_PRIORITY = 0
+QUERY_PRIORITY = 10
+
+PRIORITY_NAMES = {EXPLAIN_PRIORITY: "explain", QUERY_PRIORITY: "query"}
+
+# Settings of the Athena client used with a scheduler, see AwsClientFactory(service_settings=...).
+# Retried inside botocore, the throttling errors would hold a slot without ever reaching the scheduler:
+# few attempts and no adaptive rate, the starts are retried by call_with_throttling_retry, which reports them.
+SCHEDULED_CLIENT_SETTINGS = {'athena': {'retry_mode': 'standard', 'max_attempts': 3}}
+
+
+class ExecutionCancelled(Exception):
+    """Raised when the caller cancels an execution still waiting for a slot."""
+
+
+class AthenaExecutionScheduler:
+    def __init__(self, max_concurrent_queries=20, throttle_cooldown=2.0):
+        """
+        Args:
+        - max_concurrent_queries (int): Executions running at once, keep it under the active query quota of the account.
+        - throttle_cooldown (float): Seconds between two reductions of the concurrency limit, the throttling errors
+          of the executions started together only count once.
+        """
+        self.max_concurrent_queries = max_concurrent_queries
+        # Lowered when Athena throttles, raised back by one slot every `limit` completed executions
+        self.limit = float(max_concurrent_queries)
+        self.throttle_cooldown = throttle_cooldown
+        self.last_throttled = 0.0
+        self.running = 0
+        self.queue = []   # heap of (priority, sequence) waiting for a slot
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.in_flight = {}   # key -> Future of the execution shared by the identical requests
+        self.in_flight_lock = threading.Lock()
+        self._publish()
+
+    def run(self, function, priority=QUERY_PRIORITY, cancel_event: threading.Event = None):
+        """
+        Waits for a slot, by priority then in arrival order, and calls function, which starts an execution and waits for its end.
+
+        Args:
+        - function: Callable running the execution and returning its result.
+        - priority (int): EXPLAIN_PRIORITY or QUERY_PRIORITY.
+        - cancel_event (threading.Event): When set while waiting, ExecutionCancelled is raised and the execution is never started.
+        """
+        self._acquire(priority, cancel_event)
+        try:
+            return function()
+        finally:
+            self._release()
+
+    def coalesce(self, key, function):
+        """
+        Calls function, or waits for the result of the identical call already in flight.
+
+        Args:
+        - key: Identifies identical calls, e.g. the normalized query with its database and workgroup.
+          Calls a single caller can cancel must not be coalesced, the cancellation would reach all the waiters.
+        """
+        with self.in_flight_lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+        if not leader:
+            telemetry.increment("athena_scheduler_coalesced_total")
+            logger.info("Identical Athena execution in flight, waiting for its result")
+            return future.result()
+        try:
+            result = function()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.in_flight_lock:
+                del self.in_flight[key]
+
+    def throttled(self, error=None):
+        """Halves the concurrency limit when Athena reports too many requests, at most once per cooldown."""
+        telemetry.increment("athena_scheduler_throttled_total")
+        with self.condition:
+            now = time.monotonic()
+            if now - self.last_throttled < self.throttle_cooldown:
+                return
+            self.last_throttled = now
+            self.limit = max(1.0, self.limit / 2)
+            logger.warning(f"Athena throttled the executions, concurrency lowered to {int(self.limit)}")
+            self._publish()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {"queued": len(self.queue), "running": self.running, "limit": int(self.limit)}
+
+    def _acquire(self, priority, cancel_event):
+        start = time.monotonic()
+        entry = (priority, next(self.sequence))
+        with self.condition:
+            heapq.heappush(self.queue, entry)
+            self._publish()
+            try:
+                while self.queue[0] != entry or self.running >= int(self.limit):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise ExecutionCancelled("Cancelled while waiting for an Athena execution slot")
+                    # The cancel event is checked periodically, the other waiters are woken up by the releases
+                    self.condition.wait(0.1 if cancel_event is not None else None)
+            except BaseException:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                self.condition.notify_all()
+                self._publish()
+                raise
+            heapq.heappop(self.queue)
+            self.running += 1
+            self._publish()
+            # The next entry may be admitted as well
+            self.condition.notify_all()
+        telemetry.observe("athena_scheduler_wait_seconds", time.monotonic() - start, priority=PRIORITY_NAMES.get(priority, str(priority)))
+
+    def _release(self):
+        with self.condition:
+            self.running -= 1
+            self.limit = min(float(self.max_concurrent_queries), self.limit + 1 / self.limit)
+            self._publish()
+            self.condition.notify_all()
+
+    def _publish(self):
+        telemetry.set_gauge("athena_scheduler_queue_depth", len(self.queue))
+        telemetry.set_gauge("athena_scheduler_running", self.running)
+        telemetry.set_gauge("athena_scheduler_limit", int(self.limit))
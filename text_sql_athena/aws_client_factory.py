@@ -1,52 +1,103 @@
+import threading
+
 import boto3
 from botocore.config import Config
 from .custom_logger import logger
 
+"""
+
+    Thread-safe factory of the boto3 clients shared by every Streamlit session.
+    One client is created per service, with its own connection pool, timeouts and retry mode.
+
+"""
+
+# Services used by the application, in the order they are warmed up
+SERVICES = ('bedrock', 'bedrock-runtime', 'athena', 's3', 'glue')
+
+# Connection settings applied to every service unless overridden
+DEFAULT_CLIENT_SETTINGS = {
+    'max_pool_connections': 10,
+    'connect_timeout': 10,
+    'read_timeout': 60,
+    'retry_mode': 'standard',
+    'tcp_keepalive': True,
+}
+
+# Per-service overrides: Bedrock and Athena are called concurrently by the ingestion pipeline and the sessions,
+# model responses can take minutes to stream and Bedrock throttles aggressively
+DEFAULT_SERVICE_SETTINGS = {
+    'bedrock-runtime': {'max_pool_connections': 50, 'read_timeout': 300, 'retry_mode': 'adaptive'},
+    'athena': {'max_pool_connections': 50, 'retry_mode': 'adaptive'},
+    's3': {'max_pool_connections': 50},
+    'glue': {'max_pool_connections': 20},
+}
+
 
 # Provide boto3 client for various AWS Services
 class AwsClientFactory:
-    def __init__(self, region_name="us-east-1", max_attempts=10):
-        self.retry_config = Config(
-            region_name = region_name,
+    def __init__(self, region_name="us-east-1", max_attempts=10, service_settings: dict = None):
+        """
+        Args:
+        - region_name (str): AWS region of the clients.
+        - max_attempts (int): Maximum number of attempts of a call, retries included, unless overridden for a service.
+        - service_settings (dict): Overrides of DEFAULT_CLIENT_SETTINGS per service name, e.g. {'athena': {'max_pool_connections': 100}}.
+          Supported keys are max_pool_connections, connect_timeout, read_timeout, retry_mode ('standard' or 'adaptive'),
+          max_attempts and tcp_keepalive.
+        """
+        self.region_name = region_name
+        self.max_attempts = max_attempts
+        self.service_settings = {service: dict(settings) for service, settings in DEFAULT_SERVICE_SETTINGS.items()}
+        for service, settings in (service_settings or {}).items():
+            self.service_settings.setdefault(service, {}).update(settings)
+        self.session = boto3.session.Session()
+        self._clients = {}
+        # boto3 sessions are not thread-safe, clients are created one at a time
+        self._lock = threading.Lock()
+
+    def client_config(self, service_name: str) -> Config:
+        settings = {**DEFAULT_CLIENT_SETTINGS, **self.service_settings.get(service_name, {})}
+        return Config(
+            region_name = self.region_name,
+            max_pool_connections = settings['max_pool_connections'],
+            connect_timeout = settings['connect_timeout'],
+            read_timeout = settings['read_timeout'],
+            tcp_keepalive = settings['tcp_keepalive'],
             retries = {
-                'max_attempts': max_attempts,
-                'mode': 'standard'
-            }               
+                'max_attempts': settings.get('max_attempts', self.max_attempts),
+                'mode': settings['retry_mode']
+            }
         )
-        self.session = boto3.session.Session()
-        self._bedrock_client = None
-        self._bedrock_runtime_client = None
-        self._athena_client = None
-        self._s3_client = None
-        self._glue_client = None
 
+    def get_client(self, service_name: str):
+        """Returns the client of a service, creating it on first use."""
+        client = self._clients.get(service_name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(service_name)
+                if client is None:
+                    client = self.session.client(service_name, config=self.client_config(service_name))
+                    self._clients[service_name] = client
+                    logger.debug(f'{service_name} client created')
+        return client
+
+    def warm_up(self, services=SERVICES):
+        """Creates the clients eagerly so the first requests do not pay for endpoint and credential resolution."""
+        for service_name in services:
+            self.get_client(service_name)
+        logger.info(f"AWS clients ready: {', '.join(services)}")
+        return self
 
     def createBedrockClient(self):
-        if self._bedrock_client is None:
-            self._bedrock_client = self.session.client('bedrock',config=self.retry_config)
-            logger.debug(f'bedrock client created for profile')
-        return self._bedrock_client
-    
+        return self.get_client('bedrock')
+
     def createBedrockRuntimeClient(self):
-        if self._bedrock_runtime_client is None:
-            self._bedrock_runtime_client = self.session.client('bedrock-runtime',config=self.retry_config)
-            logger.debug(f'bedrock runtime client created ')
-        return self._bedrock_runtime_client
-    
+        return self.get_client('bedrock-runtime')
+
     def createAthenaClient(self):
-        if self._athena_client is None:
-            self._athena_client = self.session.client('athena',config=self.retry_config)
-            logger.debug(f'athena client created ')
-        return self._athena_client
-    
+        return self.get_client('athena')
+
     def createS3Client(self):
-        if self._s3_client is None:
-            self._s3_client = self.session.client('s3',config=self.retry_config)
-            logger.debug(f's3 client created !!')
-        return self._s3_client
+        return self.get_client('s3')
 
     def createGlueClient(self):
-        if self._glue_client is None:
-            self._glue_client = self.session.client('glue',config=self.retry_config)
-            logger.debug(f'Glue client created !!')
-        return self._glue_client    
+        return self.get_client('glue')
@@ -0,0 +1,261 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .custom_logger import logger
+from .rate_limiter import RateLimiter, call_with_throttling_retry
+from .telemetry import telemetry
+
+"""
+
+    Headless batch mode: translates a JSONL file of questions to SQL, without Streamlit.
+
+    Every input line is a JSON object with a "question" and optionally an "id" and a "database" restricting
+    the schema search. Every output line holds the SQL, whether it passed the validation, the number of
+    attempts and the timings. Results are appended as they complete: a run started again with the same
+    output file skips the questions already answered, only the questions that raised an error are retried.
+    At the end of a run the file is compacted: the last line of each id replaces the lines of the previous runs.
+
+    Usage: python -m text_sql_athena.batch questions.jsonl --output results.jsonl --parallelism 8
+
+"""
+
+
+class BatchQuestion:
+    def __init__(self, question_id: str, question: str, database_name: str = None):
+        self.question_id = question_id
+        self.question = question
+        self.database_name = database_name
+
+
+def read_questions(path: str) -> list[BatchQuestion]:
+    """Reads the questions of a JSONL file, the line number is the id of the questions without one."""
+    questions = []
+    with open(path, encoding="utf8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not record.get("question"):
+                raise ValueError(f"{path}:{line_number}: missing question")
+            questions.append(BatchQuestion(str(record.get("id", line_number)), record["question"], record.get("database")))
+    return questions
+
+
+def completed_ids(output_path: str) -> set[str]:
+    """Ids of the questions answered by a previous run, without error. A truncated last line is ignored."""
+    if not os.path.exists(output_path):
+        return set()
+    ids = set()
+    with open(output_path, encoding="utf8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                logger.warning(f"Ignoring an incomplete line of {output_path}")
+                continue
+            if "error" not in result:
+                ids.add(result["id"])
+    return ids
+
+
+def compact_results(output_path: str):
+    """Keeps the last line of each id, in the order of their first line, and drops the truncated lines."""
+    results = {}
+    with open(output_path, encoding="utf8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            results[result["id"]] = result
+    # Written aside then renamed, an interruption leaves the previous file intact
+    temporary_path = output_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf8") as f:
+        for result in results.values():
+            f.write(json.dumps(result) + "\n")
+    os.replace(temporary_path, output_path)
+
+
+def _terminate_last_line(path: str):
+    """Ends a file interrupted in the middle of a line, so the lines appended next stay valid."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+class BatchTranslator:
+    def __init__(self, request_factory, embeddings, parallelism=8, max_attempt=4, embedding_rate_limiter: RateLimiter = None):
+        """
+        Args:
+        - request_factory: Returns the RequestQueryBedrock of a database name, or of every database for None.
+          The requests share the rate limiters of the Bedrock and Athena calls.
+        - embeddings: Embeddings of the questions, usually the cached embeddings of the language model.
+        - parallelism (int): Number of questions translated concurrently.
+        - max_attempt (int): Maximum number of generation attempts per question.
+        - embedding_rate_limiter (RateLimiter): Limits the embedding calls made up front.
+        """
+        self.request_factory = request_factory
+        self.embeddings = embeddings
+        self.parallelism = parallelism
+        self.max_attempt = max_attempt
+        self.embedding_rate_limiter = embedding_rate_limiter
+        self._requests = {}
+        self._requests_lock = threading.Lock()
+
+    def _request(self, database_name):
+        with self._requests_lock:
+            if database_name not in self._requests:
+                self._requests[database_name] = self.request_factory(database_name)
+            return self._requests[database_name]
+
+    def _embed(self, text: str):
+        try:
+            return call_with_throttling_retry(self.embeddings.embed_query, text, rate_limiter=self.embedding_rate_limiter)
+        except Exception as e:
+            # The question is embedded again by its translation, which reports the error if it persists
+            logger.warning(f"Unable to embed a question up front: {e}")
+            return None
+
+    def embed_questions(self, questions: list[BatchQuestion]) -> dict:
+        """
+        Embeds every distinct question up front, concurrently, and returns the vectors by question text.
+        The vector of a question whose embedding failed is None.
+        """
+        texts = list(dict.fromkeys(question.question for question in questions))
+        if not texts:
+            return {}
+        with telemetry.span("batch_embedding"), ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            return dict(zip(texts, executor.map(self._embed, texts)))
+
+    def translate(self, question: BatchQuestion, query_embedding: list[float] = None) -> dict:
+        """Translates a single question, the errors are reported in the result instead of being raised."""
+        start = time.perf_counter()
+        result = {"id": question.question_id, "question": question.question, "database": question.database_name}
+        try:
+            answer = self._request(question.database_name).answer(question.question, None, max_attempt=self.max_attempt, query_embedding=query_embedding)
+            result.update({"sql": answer.sql_query, "validated": answer.validated, "attempts": answer.attempts, "from_cache": answer.from_cache})
+        except Exception as e:
+            logger.error(f"Unable to translate question {question.question_id}: {e}")
+            result.update({"sql": None, "validated": False, "attempts": 0, "from_cache": False, "error": str(e)})
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        return result
+
+    def run(self, questions: list[BatchQuestion], output_path: str, resume=True, progress_callback=None) -> dict:
+        """
+        Translates the questions concurrently and appends a JSON line per result to output_path as soon as it is available.
+
+        Args:
+        - resume (bool): Skips the questions already in output_path, otherwise the file is overwritten.
+          The file is compacted at the end of the run, one line per id, the latest one.
+        - progress_callback: Called with each result.
+
+        Returns:
+        - dict: Summary of the run.
+        """
+        start = time.perf_counter()
+        done = completed_ids(output_path) if resume else set()
+        if resume:
+            _terminate_last_line(output_path)
+        pending = [question for question in questions if question.question_id not in done]
+        logger.info(f"{len(pending)} questions to translate, {len(questions) - len(pending)} already answered")
+
+        embedding_start = time.perf_counter()
+        vectors = self.embed_questions(pending)
+        embedding_seconds = time.perf_counter() - embedding_start
+
+        summary = {"questions": len(questions), "skipped": len(questions) - len(pending), "translated": 0, "validated": 0, "failed": 0}
+        with open(output_path, "a" if resume else "w", encoding="utf8") as output, ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            futures = [executor.submit(self.translate, question, vectors.get(question.question)) for question in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                # One line per result, flushed: an interrupted run loses at most the questions in flight
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+                summary["translated"] += 1
+                summary["validated" if result["validated"] else "failed"] += 1
+                if progress_callback:
+                    progress_callback(result)
+        compact_results(output_path)
+
+        summary["embedding_seconds"] = round(embedding_seconds, 3)
+        summary["seconds"] = round(time.perf_counter() - start, 3)
+        return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Translates a JSONL file of questions to Athena SQL")
+    parser.add_argument("input", help="JSONL file of {\"id\", \"question\", \"database\"} objects")
+    parser.add_argument("--output", required=True, help="JSONL file receiving the results, also the checkpoint of the run")
+    parser.add_argument("--restart", action="store_true", help="Overwrite the output instead of resuming the previous run")
+    parser.add_argument("--database", help="Database searched by the questions without a database")
+    parser.add_argument("--parallelism", type=int, default=8, help="Questions translated concurrently")
+    parser.add_argument("--max-attempt", type=int, default=4, help="Generation attempts per question")
+    parser.add_argument("--bedrock-rps", type=float, default=2.0, help="Model calls per second")
+    parser.add_argument("--embedding-rps", type=float, default=10.0, help="Embedding calls per second")
+    parser.add_argument("--athena-rps", type=float, default=5.0, help="Athena executions started per second")
+    parser.add_argument("--athena-concurrency", type=int, default=20, help="Athena executions running at once")
+    parser.add_argument("--region", default="us-east-1")
+    parser.add_argument("--athena-bucket", required=True, help="Bucket receiving the Athena results")
+    parser.add_argument("--athena-workgroup")
+    parser.add_argument("--chromadb-path", default="./chroma.db")
+    parser.add_argument("--vector-store", choices=["chroma", "numpy"], default="chroma")
+    parser.add_argument("--vector-index-path", default="./vector_index")
+    parser.add_argument("--flat-retrieval", action="store_true", help="Disable the hierarchical schema retrieval")
+    parser.add_argument("--llm-model-id", default="us.anthropic.claude-3-5-sonnet-20241022-v2:0")
+    parser.add_argument("--embedding-model-id", default="amazon.titan-embed-text-v1")
+    parser.add_argument("--embedding-cache-path", default="./embedding_cache.db")
+    args = parser.parse_args(argv)
+
+    # The heavy modules are only needed once the arguments are valid
+    from .athena_execution import AthenaQueryExecute, ExecutionIdCache
+    from .athena_scheduler import SCHEDULED_CLIENT_SETTINGS, AthenaExecutionScheduler
+    from .aws_client_factory import AwsClientFactory
+    from .chromadb_vc_embedding import EmbeddingBedrockChroma
+    from .llm_basemodel import LanguageModel
+    from .sql_cache import SemanticSqlCache
+    from .sql_generator import RequestQueryBedrock
+    from .vector_embedding import EmbeddingBedrock
+    from .vector_store import NumpyVectorStore
+
+    client_factory = AwsClientFactory(region_name=args.region, service_settings=SCHEDULED_CLIENT_SETTINGS).warm_up()
+    language_model = LanguageModel(bedrock_client=client_factory.createBedrockRuntimeClient(), region_name=args.region,
+                                   embed_model_id=args.embedding_model_id, llm_model_id=args.llm_model_id,
+                                   embedding_cache_path=args.embedding_cache_path)
+    vector_store = NumpyVectorStore(args.vector_index_path) if args.vector_store == "numpy" else None
+    ebr_chroma = EmbeddingBedrockChroma(EmbeddingBedrock(language_model), language_model, chromadb_path=args.chromadb_path,
+                                        vector_store=vector_store, hierarchical=not args.flat_retrieval)
+    query_executor = AthenaQueryExecute(client_factory, args.athena_bucket, workgroup=args.athena_workgroup,
+                                        execution_cache=ExecutionIdCache(), rate_limiter=RateLimiter(args.athena_rps, burst=args.parallelism),
+                                        scheduler=AthenaExecutionScheduler(max_concurrent_queries=args.athena_concurrency))
+    llm_rate_limiter = RateLimiter(args.bedrock_rps, burst=args.parallelism)
+    # Identical and near identical questions of the file reuse the SQL already validated
+    sql_cache = SemanticSqlCache()
+
+    def request_factory(database_name):
+        return RequestQueryBedrock(ebr_chroma, client_factory, args.athena_bucket, language_model, sql_cache=sql_cache,
+                                   database_name=database_name, query_executor=query_executor, llm_rate_limiter=llm_rate_limiter)
+
+    questions = read_questions(args.input)
+    for question in questions:
+        question.database_name = question.database_name or args.database
+    translator = BatchTranslator(request_factory, language_model.embeddings, parallelism=args.parallelism, max_attempt=args.max_attempt,
+                                 embedding_rate_limiter=RateLimiter(args.embedding_rps, burst=args.parallelism))
+
+    def progress(result):
+        status = "valid" if result["validated"] else "FAILED"
+        print(f"{result['id']}: {status} in {result['seconds']}s", file=sys.stderr)
+
+    summary = translator.run(questions, args.output, resume=not args.restart, progress_callback=progress)
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,20 @@
+import asyncio
 
 
 from typing import Any
-from chromadb import chromadb, QueryResult
-from langchain_community.document_loaders import JSONLoader
 
 from text_sql_athena.vector_embedding import EmbeddingBedrock
 from .custom_logger import logger
 
 from .llm_basemodel import LanguageModel
 from .aws_client_factory import AwsClientFactory
+from .schema_context_builder import SchemaContextBuilder, SchemaContextStats, document_table
+from .telemetry import telemetry
+from .vector_store import COLUMN_DOCUMENT, TABLE_DOCUMENT, ChromaVectorStore, VectorStore, kind_filter
 
 """
     Here we will use Chroma as our local vector database. More details here https://docs.trychroma.com/getting-started
+    Any other VectorStore backend can be provided instead, see vector_store.py.
 
 """
 def is_empty_or_whitespace(comment):
@@ -21,33 +24,47 @@ def is_empty_or_whitespace(comment):
     return not comment.strip()  # Check if the string is empty after removing whitespace
 
 
+class RetrievalContext:
+    """Result of the schema retrieval for a user question, computed once and shared by the prompt building, the SQL generation and the UI."""
+    def __init__(self, user_query: str, query_embedding: list[float], results: dict, documents: list, schema_text: str, stats: SchemaContextStats = None,
+                 schema_subset: dict = None):
+        self.user_query = user_query
+        self.query_embedding = query_embedding
+        self.results = results
+        self.documents = documents
+        self.schema_text = schema_text
+        self.stats = stats
+        # "database.table" -> names of the matched columns, set by the hierarchical retrieval
+        self.schema_subset = schema_subset
+
+
 class EmbeddingBedrockChroma:
-    def __init__(self, embedding_bedrock: EmbeddingBedrock, language_model: LanguageModel, collection_name="athena_embed_collection", chromadb_path="chroma.db"): 
+    def __init__(self, embedding_bedrock: EmbeddingBedrock, language_model: LanguageModel, collection_name="athena_embed_collection", chromadb_path="chroma.db",
+                 context_builder: SchemaContextBuilder = None, vector_store: VectorStore = None,
+                 hierarchical=False, top_tables=5, columns_per_table=30): 
+        """
+        Args:
+        - hierarchical (bool): Ranks the table documents first, then searches the columns of the top_tables best tables only.
+        - top_tables (int): Number of tables kept by the hierarchical retrieval.
+        - columns_per_table (int): Maximum number of column documents kept per table by the hierarchical retrieval.
+        """
         self.language_model = language_model
+        self.context_builder = context_builder or SchemaContextBuilder()
         self.embeddings = embedding_bedrock.embeddings
-
-        self.chroma_client = chromadb.PersistentClient(path=chromadb_path)
-        if not self.check_if_collection_exists(collection_name):  # Check if collection exists
-            self.collection = self.chroma_client.get_or_create_collection(name=collection_name)
-            logger.warning(f"Collection '{collection_name}' created.") #confirmation message to user.
-        else:
-            self.collection = self.chroma_client.get_collection(name=collection_name) # Get collection if exist
-            logger.info(f"Collection '{collection_name}' already exists. Loading existing collection.")
-    
-    def check_if_collection_exists(self, collection_name: str):
-        try:
-            self.chroma_client.get_collection(name=collection_name)
-            return True  # Collection exists
-        except Exception as e:
-            if "does not exist" in str(e):  # Specific error for non-existent collection
-                return False  # Collection does not exist
-            else:
-                raise  # Re-raise other exceptions
+        # Chroma collection by default, opened in the background
+        self.vector_store = vector_store or ChromaVectorStore(chromadb_path=chromadb_path, collection_name=collection_name)
+        self.hierarchical = hierarchical
+        self.top_tables = top_tables
+        self.columns_per_table = columns_per_table
+        self._schema_catalog = None
     
     def add_documents(self, file_name: str):
+        # Imported on use, it pulls the langchain document loaders which are slow to import
+        from langchain_community.document_loaders import JSONLoader
         documents = JSONLoader(file_path=file_name, jq_schema='.', text_content=False, json_lines=False).load()
+        self._schema_catalog = None
 
-        self.collection.add(
+        self.vector_store.add(
             documents=[d.page_content for d in documents], # Assuming page_content holds the text
             embeddings=self.embeddings.embed_documents([d.page_content for d in documents]), # Embed with your model
             metadatas=[d.metadata for d in documents],  # Add metadata
@@ -56,31 +73,153 @@ class EmbeddingBedrockChroma:
     
     def add_json(self, document_text: str, metadata: dict[str, Any], doc_id: str):
         documents_to_add = [document_text]
+        self._schema_catalog = None
 
-        self.collection.add(
+        self.vector_store.add(
             documents=documents_to_add,
             embeddings=self.embeddings.embed_documents(documents_to_add), # Embed with your model
             metadatas=[metadata],  # Add metadata
             ids=[doc_id]
         )        
 
-    def get_similarity_search(self, user_query: str, k=200) : # remove vcindex parameter
-        query_embedding = self.embeddings.embed_query(user_query) # Embed the query
+    def add_json_batch(self, document_texts: list[str], metadatas: list[dict[str, Any]], doc_ids: list[str], embeddings: list[list[float]] = None):
+        """Adds several documents with a single collection write, embeddings are computed when not provided."""
+        if not doc_ids:
+            return
+        if embeddings is None:
+            embeddings = self.embeddings.embed_documents(document_texts)
+        self._schema_catalog = None
 
-        results : QueryResult = self.collection.query(
-            query_embeddings=query_embedding,
-            n_results=k
+        self.vector_store.add(
+            documents=document_texts,
+            embeddings=embeddings,
+            metadatas=metadatas,
+            ids=doc_ids
         )
+
+    def get_existing_ids(self, doc_ids: list[str]) -> set[str]:
+        """Returns the subset of doc_ids already stored in the collection, with a single lookup."""
+        if not doc_ids:
+            return set()
+        existing_entries = self.vector_store.get(ids=doc_ids)
+        return set(existing_entries['ids'])
+
+    def get_metadatas(self, where: dict) -> dict[str, dict]:
+        """Returns the metadata of the documents matching a where filter, by document id."""
+        entries = self.vector_store.get(where=where)
+        return dict(zip(entries['ids'], entries['metadatas']))
+
+    def delete_documents(self, doc_ids: list[str]):
+        if not doc_ids:
+            return
+        self.vector_store.delete(list(dict.fromkeys(doc_ids)))
+        self._schema_catalog = None
+
+    def persist(self):
+        """Writes the pending changes of the vector store to disk, called at the end of an import."""
+        self.vector_store.persist()
+
+    def get_schema_catalog(self) -> dict:
+        """
+        Returns the imported schema as {database: {table: set(columns)}}, with lower case names.
+        It is built from the metadata of the collection on first use and rebuilt after documents are added.
+        """
+        if self._schema_catalog is None:
+            catalog = {}
+            entries = self.vector_store.get()
+            for metadata in entries['metadatas']:
+                if not metadata:
+                    continue
+                if 'column_name' in metadata:
+                    columns = catalog.setdefault(metadata['database_name'].lower(), {}).setdefault(metadata['table_name'].lower(), set())
+                    columns.add(metadata['column_name'].lower())
+                elif 'tableName' in metadata:
+                    catalog.setdefault(metadata['databaseName'].lower(), {}).setdefault(metadata['tableName'].lower(), set())
+            self._schema_catalog = catalog
+        return self._schema_catalog
+
+    def get_similarity_search(self, user_query: str, k=200, query_embedding: list[float] = None, where: dict = None, doc_kind: str = None) : # remove vcindex parameter
+        """
+        Searches the documents nearest to the question.
+
+        Args:
+        - where (dict): Metadata filter in the Chroma syntax, e.g. {"database_name": "sales"}, applied before the search.
+        - doc_kind (str): Restricts the search to the table or the column documents.
+        """
+        if query_embedding is None:
+            query_embedding = self.embeddings.embed_query(user_query) # Embed the query
+
+        with telemetry.span("vector_search"):
+            results = self.vector_store.query(
+                query_embedding=query_embedding,
+                n_results=k,
+                where=kind_filter(where, doc_kind)
+            )
         return results # ChromaDB returns distances, ids, embeddings, and metadatas
 
-    
+    def retrieve(self, user_query: str, k=200, query_embedding: list[float] = None, database_name: str = None) -> RetrievalContext:
+        """Embeds the question and searches the collection once, returning everything the request needs."""
+        if query_embedding is None:
+            query_embedding = self.embeddings.embed_query(user_query)
+        where = {"database_name": database_name} if database_name else None
+        if self.hierarchical:
+            context = self.retrieve_hierarchical(user_query, query_embedding, where)
+            if context is not None:
+                return context
+        results = self.get_similarity_search(user_query, k=k, query_embedding=query_embedding, where=where)
+        documents = self.transform_data(results)
+        with telemetry.span("schema_context"):
+            schema_text, stats = self.context_builder.build(documents)
+        return RetrievalContext(user_query, query_embedding, results, documents, schema_text, stats)
+
+    def retrieve_hierarchical(self, user_query: str, query_embedding: list[float], where: dict = None) -> RetrievalContext:
+        """
+        Two-stage retrieval: the table documents are ranked first, then the column search is restricted to the best tables.
+        The relevant columns of a table can no longer be crowded out by the columns of many loosely related tables.
+
+        Returns:
+        - RetrievalContext: The selected tables and columns, or None when the collection has no table documents
+          with a doc_kind, e.g. imported by a previous version, and the flat search must be used.
+        """
+        table_results = self.get_similarity_search(user_query, k=self.top_tables, query_embedding=query_embedding, where=where, doc_kind=TABLE_DOCUMENT)
+        table_documents = self.transform_data(table_results)
+        if not table_documents:
+            return None
+
+        tables = [document_table(document)[:2] for document in table_documents]
+        table_filter = [{"$and": [{"database_name": database}, {"table_name": table}]} for database, table in tables]
+        column_results = self.get_similarity_search(user_query, k=self.columns_per_table * len(tables), query_embedding=query_embedding,
+                                                    where=table_filter[0] if len(table_filter) == 1 else {"$or": table_filter}, doc_kind=COLUMN_DOCUMENT)
+
+        # Documents grouped by table, in the order of the table ranking
+        schema_subset = {f"{database}.{table}": [] for database, table in tables}
+        documents = list(table_documents)
+        for document in self.transform_data(column_results):
+            database, table, _ = document_table(document)
+            columns = schema_subset[f"{database}.{table}"]
+            if len(columns) < self.columns_per_table:
+                columns.append(document['metadata']['column_name'])
+                documents.append(document)
+
+        results = {key: table_results[key][0] + column_results[key][0] for key in ("ids", "documents", "metadatas", "distances")}
+        with telemetry.span("schema_context"):
+            schema_text, stats = self.context_builder.build(documents)
+        logger.info(f"Hierarchical retrieval: {len(tables)} tables, {len(documents) - len(tables)} columns")
+        return RetrievalContext(user_query, query_embedding, {key: [value] for key, value in results.items()}, documents, schema_text, stats, schema_subset)
+
+    async def aretrieve(self, user_query: str, k=200, query_embedding: list[float] = None, database_name: str = None) -> RetrievalContext:
+        """Async version of retrieve, the embedding and the vector search run outside of the event loop."""
+        if query_embedding is None:
+            query_embedding = await self.embeddings.aembed_query(user_query)
+        return await asyncio.to_thread(self.retrieve, user_query, k, query_embedding, database_name)
+
     def format_metadata(self,documents: list):
         docstr = map(lambda x: x['doc'], documents)
         result = '\n'.join(docstr)
 
         return result
     
-    def transform_data(self, results : QueryResult):        
+    def transform_data(self, results : dict):        
         docs = []
         nb_docs = len(results['ids'][0])
         logger.debug(nb_docs)
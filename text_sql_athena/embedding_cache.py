@@ -0,0 +1,171 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+from .custom_logger import logger
+from .telemetry import telemetry
+
+"""
+
+    Content addressed cache for the embeddings computed by Bedrock.
+    Vectors are kept in a small in-process LRU and persisted in a SQLite database so they survive restarts.
+
+"""
+
+# Embeddings of documents and queries can differ for some models, they are cached separately
+DOCUMENT_PURPOSE = "document"
+QUERY_PURPOSE = "query"
+
+# Maximum number of keys looked up by a single SQLite statement
+SQLITE_BATCH_SIZE = 500
+
+
+class EmbeddingCache:
+    def __init__(self, path: str, model_id: str, max_bytes=512 * 1024 * 1024, memory_entries=4096):
+        """
+        Args:
+        - path (str): SQLite database file, ":memory:" keeps the cache in process only.
+        - model_id (str): Embedding model id, the cache is purged when it changes.
+        - max_bytes (int): Maximum size of the stored vectors, least recently used ones are evicted above it.
+        - memory_entries (int): Number of vectors kept in the in-process LRU tier.
+        """
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.memory_cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache_metadata (name TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, last_access REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        row = self.connection.execute("SELECT value FROM cache_metadata WHERE name = 'model_id'").fetchone()
+        if row is None or row[0] != model_id:
+            if row is not None:
+                logger.warning(f"Embedding model changed from {row[0]} to {model_id}, purging the embedding cache")
+            self.connection.execute("DELETE FROM embeddings")
+            self.connection.execute("INSERT OR REPLACE INTO cache_metadata (name, value) VALUES ('model_id', ?)", (model_id,))
+        self.connection.commit()
+        self.stored_bytes = self.connection.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+    def make_key(self, text: str, purpose: str) -> str:
+        return hashlib.sha256(f"{self.model_id}\0{purpose}\0{text}".encode('utf8')).hexdigest()
+
+    def get_many(self, texts: list[str], purpose: str) -> list:
+        """Returns the cached vector of each text, or None when it is not cached."""
+        keys = [self.make_key(text, purpose) for text in texts]
+        results = [None] * len(keys)
+        with self.lock:
+            missing = {}
+            for i, key in enumerate(keys):
+                vector = self.memory_cache.get(key)
+                if vector is not None:
+                    self.memory_cache.move_to_end(key)
+                    results[i] = vector
+                else:
+                    missing.setdefault(key, []).append(i)
+
+            if missing:
+                stored = []
+                missing_keys = list(missing)
+                for start in range(0, len(missing_keys), SQLITE_BATCH_SIZE):
+                    batch = missing_keys[start:start + SQLITE_BATCH_SIZE]
+                    stored.extend(self.connection.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                    ).fetchall())
+                for key, blob in stored:
+                    vector = array('f', blob).tolist()
+                    self._remember(key, vector)
+                    for i in missing[key]:
+                        results[i] = vector
+                if stored:
+                    now = time.time()
+                    self.connection.executemany("UPDATE embeddings SET last_access = ? WHERE key = ?", [(now, key) for key, _ in stored])
+                    self.connection.commit()
+
+            found = sum(1 for vector in results if vector is not None)
+            self.hits += found
+            self.misses += len(results) - found
+        telemetry.record_cache("embedding", found, len(results) - found)
+        return results
+
+    def put_many(self, texts: list[str], vectors: list[list[float]], purpose: str):
+        now = time.time()
+        blobs = {} # key -> vector bytes, the last vector of a text repeated in the batch wins
+        with self.lock:
+            for text, vector in zip(texts, vectors):
+                key = self.make_key(text, purpose)
+                self._remember(key, vector)
+                blobs[key] = array('f', vector).tobytes()
+            # The replaced vectors are already counted, only the size difference is added
+            replaced_bytes = 0
+            keys = list(blobs)
+            for start in range(0, len(keys), SQLITE_BATCH_SIZE):
+                batch = keys[start:start + SQLITE_BATCH_SIZE]
+                replaced_bytes += self.connection.execute(
+                    f"SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchone()[0]
+            self.connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                                        [(key, blob, now) for key, blob in blobs.items()])
+            self.stored_bytes += sum(len(blob) for blob in blobs.values()) - replaced_bytes
+            if self.stored_bytes > self.max_bytes:
+                self._evict()
+            self.connection.commit()
+
+    def _remember(self, key, vector):
+        self.memory_cache[key] = vector
+        self.memory_cache.move_to_end(key)
+        while len(self.memory_cache) > self.memory_entries:
+            self.memory_cache.popitem(last=False)
+
+    def _evict(self):
+        """Deletes the least recently used vectors until the cache is back under 90% of max_bytes."""
+        target = self.max_bytes * 0.9
+        evicted = 0
+        while self.stored_bytes > target:
+            rows = self.connection.execute("SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_access LIMIT 1000").fetchall()
+            if not rows:
+                self.stored_bytes = 0
+                break
+            batch = []
+            for key, size in rows:
+                batch.append((key,))
+                self.stored_bytes -= size
+                if self.stored_bytes <= target:
+                    break
+            self.connection.executemany("DELETE FROM embeddings WHERE key = ?", batch)
+            evicted += len(batch)
+        logger.info(f"{evicted} embeddings evicted from the cache")
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper serving the vectors from an EmbeddingCache and computing only the missing ones."""
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = self.cache.get_many(texts, DOCUMENT_PURPOSE)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Identical texts in the same batch are embedded once
+            missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+            computed = dict(zip(missing_texts, self.embeddings.embed_documents(missing_texts)))
+            self.cache.put_many(missing_texts, [computed[text] for text in missing_texts], DOCUMENT_PURPOSE)
+            for i in missing:
+                vectors[i] = computed[texts[i]]
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        vector = self.cache.get_many([text], QUERY_PURPOSE)[0]
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put_many([text], [vector], QUERY_PURPOSE)
+        return vector
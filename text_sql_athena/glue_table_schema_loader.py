@@ -1,9 +1,17 @@
+import hashlib
+import json
 import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from text_sql_athena.aws_client_factory import AwsClientFactory
 from .custom_logger import logger
 from .chromadb_vc_embedding import EmbeddingBedrockChroma
 from .llm_basemodel import LanguageModel
+from .rate_limiter import RateLimiter, call_with_throttling_retry
+from .schema_documents import SCHEMA_DOCUMENT_FORMAT, clean_text, column_document, column_metadata, partition_keys, table_document
+from .sql_cache import SemanticSqlCache
+from .telemetry import telemetry
+from .vector_store import TABLE_DOCUMENT
 
 
 """
@@ -13,6 +21,29 @@ from .llm_basemodel import LanguageModel
 """
 
 
+def table_fingerprint(table) -> str:
+    """
+    Hash of the columns, partition keys and description of a Glue table,
+    changes when a column is added, removed, renamed, retyped or commented.
+    """
+    columns = [column_fingerprint(column) for column in table_columns(table)]
+    columns.append(clean_text(table.get('Description')))
+    return hashlib.sha256(json.dumps(columns).encode('utf8')).hexdigest()
+
+
+def column_fingerprint(column) -> str:
+    return hashlib.sha256(json.dumps([column['Name'], column['Type'], column.get('Comment', '')]).encode('utf8')).hexdigest()
+
+
+def table_columns(table) -> list:
+    """Columns documented for a Glue table, the partition keys last."""
+    return table['StorageDescriptor']['Columns'] + partition_keys(table)
+
+
+def column_doc_id(databaseName, tableName, columnName) -> str:
+    return str(uuid.uuid5(uuid .NAMESPACE_DNS, f"{databaseName}.{tableName}.{columnName}")) # Generate a deterministic ID
+
+
 def is_empty_or_whitespace(comment):
     """Checks if a string is None, empty, or contains only whitespace."""
     if comment is None:
@@ -22,118 +53,277 @@ def is_empty_or_whitespace(comment):
 
 class GlueTableSchemaLoader:
     
-    def __init__(self, chromaEmbeddingDB: EmbeddingBedrockChroma, region: str, client_factory: AwsClientFactory, language_model: LanguageModel): 
+    def __init__(self, chromaEmbeddingDB: EmbeddingBedrockChroma, region: str, client_factory: AwsClientFactory, language_model: LanguageModel,
+                 max_workers=8, llm_requests_per_second=2.0, embedding_requests_per_second=10.0, write_batch_size=100,
+                 sql_cache: SemanticSqlCache = None, enrichment_batch_size=50): 
         self.chroma_db = chromaEmbeddingDB
         self.aws_region = region
         self.bedrock_runtime_client = client_factory.createBedrockRuntimeClient()
         self.glue_client = client_factory.createGlueClient()
         self.llm = language_model.llm
+        # Ingestion pipeline settings: Bedrock calls run in a bounded pool, rate limited per model
+        self.max_workers = max_workers
+        self.write_batch_size = write_batch_size
+        # Number of uncommented columns described by a single model call
+        self.enrichment_batch_size = enrichment_batch_size
+        self.llm_rate_limiter = RateLimiter(llm_requests_per_second, burst=max_workers)
+        self.embedding_rate_limiter = RateLimiter(embedding_requests_per_second, burst=max_workers)
+        # Cached SQL generated against re-imported tables is invalidated
+        self.sql_cache = sql_cache
                 
 
-    def load_embedding_from_glue_data_tables(self, database_name: str, progress_callback=None):
-        """Loads embeddings from Glue data tables into the Chroma collection."""
-        
-        # Get description from database      # Get description from database
-        response = self.glue_client.get_database(Name=database_name)
-        database_description = ""
-        if 'Parameters' in response['Database'] and 'description' in response['Database']['Parameters']:
-            database_description = response['Database']['Parameters']['description']
+    def load_embedding_from_glue_data_tables(self, database_name: str, progress_callback=None, incremental=False):
+        """
+        Loads embeddings from Glue data tables into the Chroma collection.
 
-        #Fetch all the tables and handle the pagination
-        all_tables = []
-        response = self.glue_client.get_tables(DatabaseName=database_name)
-        all_tables.extend(response['TableList'])
+        In incremental mode the unchanged tables are skipped, the documents of the changed columns are
+        re-embedded and the documents of the dropped columns and tables are deleted.
+        """
+        
+        with telemetry.span("glue_list_tables"):
+            # Get description from database      # Get description from database
+            response = self.glue_client.get_database(Name=database_name)
+            database_description = ""
+            if 'Parameters' in response['Database'] and 'description' in response['Database']['Parameters']:
+                database_description = response['Database']['Parameters']['description']
 
-        while 'NextToken' in response:
-            response = self.glue_client.get_tables(
-                DatabaseName=database_name, NextToken=response['NextToken']
-            )
+            #Fetch all the tables and handle the pagination
+            all_tables = []
+            response = self.glue_client.get_tables(DatabaseName=database_name)
             all_tables.extend(response['TableList'])
 
-        total_tables = len(all_tables)
-        processed_tables = 0
-        # Import the table in the vector database
-        for table in all_tables:
-            self.load_glue_table(table, database_description)
-            processed_tables += 1
-            if progress_callback:
-                progress_callback(processed_tables / total_tables)
+            while 'NextToken' in response:
+                response = self.glue_client.get_tables(
+                    DatabaseName=database_name, NextToken=response['NextToken']
+                )
+                all_tables.extend(response['TableList'])
+
+        # Import the tables in the vector database
+        with telemetry.span("glue_import"):
+            if incremental:
+                self.sync_glue_tables(database_name, all_tables, database_description, progress_callback)
+            else:
+                self.load_glue_tables(all_tables, database_description, progress_callback)
+            self.chroma_db.persist()
+
+
+    def sync_glue_tables(self, database_name: str, tables: list, database_description, progress_callback=None):
+        """Synchronizes the collection with the current Glue tables of a database, only touching what changed."""
+        # Single lookup of the fingerprints stored with the table documents of the database
+        stored_tables = self.chroma_db.get_metadatas({"databaseName": database_name})
+
+        changed_tables = []
+        for table in tables:
+            metadata = stored_tables.pop(f"{database_name}.{table['Name']}", None)
+            # Documents imported by a previous version are re-imported to get the current texts and metadata
+            if metadata is not None and metadata.get('columns_hash') == table_fingerprint(table) and metadata.get('document_format') == SCHEMA_DOCUMENT_FORMAT \
+                    and metadata.get('database_description', database_description) == database_description:
+                logger.debug(f"Table {table['Name']} unchanged, skipping.")
+                continue
+            changed_tables.append(table)
+            self._delete_stale_documents(table, metadata is not None)
+
+        # Tables dropped from Glue
+        dropped_tables = [metadata['tableName'] for metadata in stored_tables.values()]
+        for table_name in dropped_tables:
+            column_ids = self.chroma_db.get_metadatas({"$and": [{"database_name": database_name}, {"table_name": table_name}]})
+            self.chroma_db.delete_documents([f"{database_name}.{table_name}"] + list(column_ids))
+        if dropped_tables:
+            logger.info(f"{len(dropped_tables)} dropped tables removed: {dropped_tables}")
+            if self.sql_cache is not None:
+                self.sql_cache.invalidate_tables(database_name, dropped_tables)
+
+        logger.info(f"{len(changed_tables)} tables changed, {len(tables) - len(changed_tables)} unchanged")
+        skipped = len(tables) - len(changed_tables)
+
+        def scaled_progress(progress):
+            progress_callback((skipped + progress * len(changed_tables)) / len(tables))
+
+        if progress_callback and skipped:
+            progress_callback(skipped / len(tables))
+        self.load_glue_tables(changed_tables, database_description, scaled_progress if progress_callback else None)
+
+
+    def _delete_stale_documents(self, table, table_document_exists: bool):
+        """Deletes the table document and the documents of the columns dropped or modified, they are re-created by the load."""
+        databaseName = table['DatabaseName']
+        tableName = table['Name']
+        current_columns = {column_doc_id(databaseName, tableName, column['Name']): column for column in table_columns(table)}
+        stored_columns = self.chroma_db.get_metadatas({"$and": [{"database_name": databaseName}, {"table_name": tableName}]})
+
+        table_doc_id = f"{databaseName}.{tableName}"
+        stale_ids = [table_doc_id] if table_document_exists else []
+        for doc_id, metadata in stored_columns.items():
+            if doc_id == table_doc_id:
+                continue
+            column = current_columns.get(doc_id)
+            if column is None:
+                stale_ids.append(doc_id)
+            elif metadata.get('column_hash', column_fingerprint(column)) != column_fingerprint(column) or metadata.get('column_type') != column['Type'] \
+                    or metadata.get('document_format') != SCHEMA_DOCUMENT_FORMAT:
+                stale_ids.append(doc_id)
+        self.chroma_db.delete_documents(stale_ids)
+        logger.info(f"Table {tableName} changed, {len(stale_ids)} stale documents deleted")
 
 
     def load_glue_table(self, table, database_description):
         """Helper method to load a single Glue table's schema."""
+        self.load_glue_tables([table], database_description)
+
+
+    def load_glue_tables(self, tables: list, database_description, progress_callback=None):
+        """
+        Loads the schema of several Glue tables through a pipeline.
+
+        For every table the existing column documents are looked up with a single request, then the comment
+        generation, batched per table, and the embedding of each document run in a bounded thread pool,
+        and the documents are written to the collection in batches as they complete.
+
+        Args:
+        - tables (list): Glue tables as returned by get_tables.
+        - database_description (str): Description of the database owning the tables.
+        - progress_callback: Called with the ratio of tables completely written.
+        """
+        total_tables = len(tables)
+        if total_tables == 0:
+            return
+        processed_tables = 0
+        remaining_documents = {}   # table index -> number of documents not yet prepared
+        completed_tables = 0       # tables whose documents are all prepared but maybe still buffered
+        pending = []               # prepared documents waiting for the next batch write
+        table_documents = {}       # table index -> table document, written once every column document is prepared
+        failed_tables = set()      # indexes of the tables with a document that could not be prepared
+        failures = 0
+
+        def flush():
+            nonlocal pending, completed_tables, processed_tables
+            if pending:
+                doc_texts, metadatas, doc_ids, embeddings = map(list, zip(*pending))
+                with telemetry.span("vector_store_write"):
+                    self.chroma_db.add_json_batch(doc_texts, metadatas, doc_ids, embeddings=embeddings)
+                logger.info(f"{len(pending)} documents written to the collection")
+                pending = []
+            if completed_tables:
+                processed_tables += completed_tables
+                completed_tables = 0
+                if progress_callback:
+                    progress_callback(processed_tables / total_tables)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {} # future -> (table index, jobs it prepares)
+
+            def submit_embeddings(index, jobs):
+                for job in jobs:
+                    futures[executor.submit(self._prepare_document, *job)] = (index, None)
+
+            for index, table in enumerate(tables):
+                jobs = self._table_jobs(table, database_description)
+                remaining_documents[index] = len(jobs)
+                if not jobs:
+                    completed_tables += 1
+                elif self.sql_cache is not None:
+                    self.sql_cache.invalidate_tables(table['DatabaseName'], [table['Name']])
+
+                # Uncommented columns are described by the model in batches before being embedded
+                to_describe, to_embed = [], []
+                for job in jobs:
+                    column, metadata = job[1], job[2]
+                    (to_describe if column is not None and is_empty_or_whitespace(metadata['column_description']) else to_embed).append(job)
+                submit_embeddings(index, to_embed)
+                for start in range(0, len(to_describe), self.enrichment_batch_size):
+                    chunk = to_describe[start:start + self.enrichment_batch_size]
+                    futures[executor.submit(self.enrich_comments, table, [job[2] for job in chunk])] = (index, chunk)
+            flush()
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, chunk = futures.pop(future)
+                    if chunk is not None:
+                        # Comments generated, the documents can be embedded
+                        try:
+                            future.result()
+                        except Exception as e:
+                            logger.error(f"Unable to describe the columns of table {tables[index]['Name']}: {e}")
+                        submit_embeddings(index, chunk)
+                        continue
+                    try:
+                        document = future.result()
+                        if document[1]['doc_kind'] == TABLE_DOCUMENT:
+                            table_documents[index] = document
+                        else:
+                            pending.append(document)
+                    except Exception as e:
+                        failures += 1
+                        failed_tables.add(index)
+                        logger.error(f"Unable to prepare a document of table {tables[index]['Name']}: {e}")
+                    remaining_documents[index] -= 1
+                    if remaining_documents[index] == 0:
+                        completed_tables += 1
+                        # The fingerprint of the table document marks the table as imported: without it the next sync imports the table again
+                        if index in failed_tables:
+                            table_documents.pop(index, None)
+                            logger.warning(f"Table {tables[index]['Name']} partially imported, it is imported again by the next sync")
+                        elif index in table_documents:
+                            pending.append(table_documents.pop(index))
+                    if len(pending) >= self.write_batch_size:
+                        flush()
+            flush()
+
+        if failures:
+            logger.warning(f"{failures} documents could not be imported")
+
+
+    def _table_jobs(self, table, database_description):
+        """Lists the documents to prepare for a table, skipping the columns already in the collection."""
         
         databaseName = table['DatabaseName']
         tableName = table['Name']            
 
         logger.info(f"Loading table: {table['Name']}")
-        logger.info(table)
+        telemetry.log_payload("Glue table: %s", table)
         
         # Add a document with the information about the table.
-        table_metadata = { "databaseName": databaseName, "tableName": tableName}
-        self.chroma_db.add_json(document_text = f"""
-                                The table {table['Name']} is part of the database {table['DatabaseName']}.
-                                The database has for purpose {database_description}.
-                                
-                                The table metadata is "
-                                {table}
-                                "
-                                """, metadata = table_metadata, doc_id = f"{databaseName}.{tableName}")
-        
-        for column in table['StorageDescriptor']['Columns']:
-            columnName = column['Name']
+        table_doc_text, table_metadata = table_document(table, database_description)
+        table_metadata.update({
+            "version_id": str(table.get('VersionId', '')),
+            "update_time": str(table.get('UpdateTime', '')),
+            "columns_hash": table_fingerprint(table)
+        })
+        table_doc_id = f"{databaseName}.{tableName}"
 
-            doc_id = str(uuid.uuid5(uuid .NAMESPACE_DNS, f"{databaseName}.{tableName}.{columnName}")) # Generate a deterministic ID
+        columns = table_columns(table)
+        partition_count = len(partition_keys(table))
+        column_ids = [column_doc_id(databaseName, tableName, column['Name']) for column in columns]
 
-            # Check if an entry with this ID already exists
-            existing_entry = self.chroma_db.collection.get(ids=[doc_id])
-            if existing_entry and existing_entry['ids']:
+        # Check with a single request which entries already exist
+        existing_ids = self.chroma_db.get_existing_ids([table_doc_id] + column_ids)
+        jobs = []
+        if table_doc_id not in existing_ids:
+            jobs.append((table, None, table_metadata, table_doc_id, table_doc_text))
+        for index, (column, doc_id) in enumerate(zip(columns, column_ids)):
+            columnName = column['Name']
+            if doc_id in existing_ids:
                 logger.info(f"Entry already exists for {tableName}.{columnName}, skipping.")
                 continue  # Skip to the next column
-            
                     
-            metadata = { 
-                "database_name": databaseName,
-                "database_description": database_description,
-                "table_name": tableName,
-                "table_description" : table.get('Description', ''),
-                "column_name": columnName,
-                "column_type": column['Type'],
-                "column_description": column.get('Comment', '')
-            }
-            
-            comment = self.enrich_comment(table, metadata)
-            
-            doc_text =f"""
-            Database : {databaseName}
-            Database Description : {database_description}
-            Table : {metadata['table_name']}
-            Table Description : {metadata['table_description']}
-            Column : {columnName}
-            Column Type : {metadata['column_type']}
-            Column Description : {metadata['column_description']}
-            """
-            
+            metadata = column_metadata(table, column, database_description, is_partition_key=index >= len(columns) - partition_count)
+            metadata["column_hash"] = column_fingerprint(column)
+            jobs.append((table, column, metadata, doc_id, None))
+        return jobs
 
 
-            
+    def _prepare_document(self, table, column, metadata, doc_id, doc_text):
+        """Runs in the pool: generates the missing column comment and embeds the document."""
+        if column is not None:
+            comment = self.enrich_comment(table, metadata)
+            doc_text = column_document(metadata)
             column['Comment'] = comment[:254]
-            
-            self.chroma_db.add_json(document_text = doc_text, metadata = metadata, doc_id = doc_id)
-        
-        # Update the table schema directly in Glue        
-        # updated_columns = table['StorageDescriptor']['Columns']  # Accumulate columns
-
-        # try:
-        #     self.glue_client.update_table(
-        #         DatabaseName=table['DatabaseName'],
-        #         TableInput={"Name": table['Name'], "StorageDescriptor": {"Columns": updated_columns}}
-        #     )
-        #     logger.info(f"Glue table {table['Name']} schema updated.")
-        # except Exception as e:
-        #     logger.error(f"Error updating Glue schema: {e}")
-        
-            
+
+        with telemetry.span("document_embedding"):
+            embedding = call_with_throttling_retry(self.chroma_db.embeddings.embed_documents, [doc_text], rate_limiter=self.embedding_rate_limiter)[0]
+        return doc_text, metadata, doc_id, embedding
+
 
     def get_glue_databases(self):
         databases = []
@@ -166,7 +356,9 @@ class GlueTableSchemaLoader:
                 Column Type: {doc['column_type']}
                 """),
             ]
-            ai_msg = self.llm.invoke(messages)
+            with telemetry.span("column_enrichment"):
+                ai_msg = call_with_throttling_retry(self.llm.invoke, messages, rate_limiter=self.llm_rate_limiter)
+            telemetry.record_llm_usage(ai_msg, "column_enrichment")
             comment = ai_msg.content
 
             doc['column_description'] = comment  # Update the doc dictionary
@@ -175,3 +367,49 @@ class GlueTableSchemaLoader:
         else:
             logger.debug(f"Column description already exist for {table['Name']}.{doc['column_name']}")
         return comment
+
+
+    def enrich_comments(self, table, docs: list):
+        """
+        Generates the missing descriptions of several columns of a table with a single model call.
+
+        The model answers with a JSON object mapping each column name to its description. The columns
+        missing from the answer, or when the answer cannot be parsed, fall back to enrich_comment.
+        """
+        logger.debug(f"Generating comments for {len(docs)} columns of {table['Name']}")
+        columns = "\n".join(f"- {doc['column_name']} ({doc['column_type']})" for doc in docs)
+        messages = [
+            (
+                "system",
+                f"""
+            You are a helpful AI assistant specialized in generating database column descriptions.  \
+            Given the table name and the list of columns below, provide a concise and informative description of each column's purpose.  \
+            Answer only with a JSON object whose keys are the column names and whose values are the descriptions.
+        """
+            ),
+            ("human", f"""
+            
+            Table Name: {table['Name']}
+            Columns:
+            {columns}
+            """),
+        ]
+        descriptions = {}
+        try:
+            with telemetry.span("column_enrichment"):
+                ai_msg = call_with_throttling_retry(self.llm.invoke, messages, rate_limiter=self.llm_rate_limiter)
+            telemetry.record_llm_usage(ai_msg, "column_enrichment")
+            content = ai_msg.content
+            descriptions = json.loads(content[content.index('{'):content.rindex('}') + 1])
+            if not isinstance(descriptions, dict):
+                descriptions = {}
+        except Exception as e:
+            logger.warning(f"Unable to parse the column descriptions of {table['Name']}, describing them one by one: {e}")
+
+        for doc in docs:
+            description = descriptions.get(doc['column_name'])
+            if isinstance(description, str) and not is_empty_or_whitespace(description):
+                doc['column_description'] = description
+                logger.info(f"Column updated for {table['Name']}.{doc['column_name']} with {description}")
+            else:
+                self.enrich_comment(table, doc)
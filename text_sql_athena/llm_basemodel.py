@@ -2,8 +2,10 @@
 from langchain_community.embeddings import BedrockEmbeddings
 from langchain_aws import ChatBedrock
 
+from .embedding_cache import CachedEmbeddings, EmbeddingCache
+
 class LanguageModel():
-    def __init__(self,bedrock_client, embed_model_id="amazon.titan-embed-text-v1", llm_model_id= "us.anthropic.claude-3-5-sonnet-20241022-v2:0" , region_name= "us-east-1"):
+    def __init__(self,bedrock_client, embed_model_id="amazon.titan-embed-text-v1", llm_model_id= "us.anthropic.claude-3-5-sonnet-20241022-v2:0" , region_name= "us-east-1", embedding_cache_path=None, embedding_cache_max_bytes=512 * 1024 * 1024):
         self.bedrock_client = bedrock_client
         self.embed_model_id = embed_model_id
         self.llm_model_id = llm_model_id
@@ -33,3 +35,7 @@ class LanguageModel():
             model_id=self.embed_model_id, 
             region_name=self.region_name
         )
+        # Serve the embeddings already computed from a persistent cache
+        if embedding_cache_path is not None:
+            self.embedding_cache = EmbeddingCache(embedding_cache_path, self.embed_model_id, max_bytes=embedding_cache_max_bytes)
+            self.embeddings = CachedEmbeddings(self.embeddings, self.embedding_cache)
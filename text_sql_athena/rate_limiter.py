@@ -0,0 +1,80 @@
+import random
+import threading
+import time
+
+from .custom_logger import logger
+from .telemetry import telemetry
+
+"""
+
+    Client-side throttling helpers shared by the components calling Bedrock and Athena concurrently.
+
+"""
+
+# Error codes returned by AWS services when a request is throttled
+THROTTLING_ERROR_CODES = ("ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException", "Throttling")
+
+
+def is_throttling_error(error: Exception) -> bool:
+    """Checks if an exception, raised by boto3 or wrapped by langchain, is a throttling error."""
+    message = str(error)
+    return any(code in message for code in THROTTLING_ERROR_CODES)
+
+
+class RateLimiter:
+    """Thread-safe token bucket allowing rate_per_second calls on average, with bursts up to burst calls."""
+    def __init__(self, rate_per_second: float, burst: int = 1):
+        self.rate_per_second = rate_per_second
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call is allowed."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate_per_second)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate_per_second
+            time.sleep(wait)
+
+
+def call_with_throttling_retry(function, *args, rate_limiter: RateLimiter = None, max_retries=6, initial_delay=1.0, max_delay=30.0,
+                               on_throttled=None, **kwargs):
+    """
+    Calls function, waiting for the rate limiter first and retrying with exponential backoff when throttled.
+
+    Args:
+    - function: Callable to invoke with args and kwargs.
+    - rate_limiter (RateLimiter): Optional limiter acquired before every attempt.
+    - max_retries (int): Number of retries after a throttling error before giving up.
+    - on_throttled: Optional callback receiving each throttling error, e.g. to lower a concurrency limit.
+
+    Returns:
+    - The function result. Non throttling errors are raised immediately.
+    """
+    delay = initial_delay
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            if not is_throttling_error(e):
+                raise
+            if on_throttled is not None:
+                on_throttled(e)
+            if attempt >= max_retries:
+                raise
+            attempt += 1
+            telemetry.increment("throttling_retries_total", operation=getattr(function, '__name__', 'call'))
+            sleep_time = random.uniform(delay / 2, delay)
+            logger.warning(f"Throttled, retrying in {sleep_time:.1f}s (retry {attempt}/{max_retries})")
+            time.sleep(sleep_time)
+            delay = min(delay * 2, max_delay)
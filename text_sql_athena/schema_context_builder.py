@@ -0,0 +1,117 @@
+import re
+
+from .custom_logger import logger
+from .schema_documents import is_compact_document
+
+"""
+
+    Builds the schema part of the SQL generation prompt from the documents returned by the vector search.
+    The most relevant tables and columns are packed into a token budget instead of pasting every hit.
+
+"""
+
+# Claude averages about 4 characters per token on schema like English text
+CHARS_PER_TOKEN = 4
+
+_INDENTATION = re.compile(r'\n[ \t]+')
+
+
+def estimate_tokens(text: str) -> int:
+    """Fast local estimation of the number of tokens of a text, no tokenizer round-trip."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def compact_text(text: str) -> str:
+    """Removes the indentation of the documents imported by previous versions, it only costs tokens."""
+    return _INDENTATION.sub('\n', text).strip()
+
+
+def document_table(document: dict):
+    """Returns (database, table, is_table_document) for a document produced by transform_data."""
+    metadata = document.get('metadata') or {}
+    if 'tableName' in metadata:
+        return metadata.get('databaseName'), metadata['tableName'], True
+    return metadata.get('database_name'), metadata.get('table_name'), False
+
+
+class SchemaContextStats:
+    """Token accounting of a built schema context."""
+    def __init__(self, tokens_used: int, tokens_retrieved: int, documents_used: int, documents_retrieved: int):
+        self.tokens_used = tokens_used
+        self.tokens_retrieved = tokens_retrieved
+        self.tokens_saved = tokens_retrieved - tokens_used
+        self.documents_used = documents_used
+        self.documents_retrieved = documents_retrieved
+
+    def __repr__(self):
+        return (f"SchemaContextStats(tokens_used={self.tokens_used}, tokens_saved={self.tokens_saved}, "
+                f"documents_used={self.documents_used}/{self.documents_retrieved})")
+
+
+class SchemaContextBuilder:
+    def __init__(self, token_budget=8000, max_distance=None):
+        """
+        Args:
+        - token_budget (int): Maximum estimated number of tokens of the schema context.
+        - max_distance (float): Hits farther than this distance from the question are dropped, None keeps them all.
+        """
+        self.token_budget = token_budget
+        self.max_distance = max_distance
+
+    def build(self, documents: list):
+        """
+        Groups the hits by table, drops the irrelevant and redundant ones and packs the rest into the token budget.
+
+        Args:
+        - documents (list): Documents as returned by EmbeddingBedrockChroma.transform_data.
+
+        Returns:
+        - (str, SchemaContextStats): The schema context and its token accounting.
+        """
+        # Documents built by schema_documents are used as is, only the legacy ones are compacted
+        texts = [document['doc'] or '' if is_compact_document(document.get('metadata')) else compact_text(document['doc'] or '')
+                 for document in documents]
+        tokens = [estimate_tokens(text) for text in texts]
+        tokens_retrieved = sum(estimate_tokens(document['doc'] or '') for document in documents)
+
+        # Group the hits by table, remembering the best distance of each table
+        groups = {}
+        for i, document in enumerate(documents):
+            if self.max_distance is not None and document['distance'] > self.max_distance:
+                continue
+            database, table, is_table_document = document_table(document)
+            group = groups.setdefault((database, table), {"distance": document['distance'], "table": None, "columns": []})
+            group["distance"] = min(group["distance"], document['distance'])
+            if is_table_document:
+                group["table"] = i
+            else:
+                group["columns"].append(i)
+
+        selected = []
+        tokens_used = 0
+        for group in sorted(groups.values(), key=lambda g: g["distance"]):
+            candidates = sorted(group["columns"], key=lambda i: documents[i]['distance'])
+            table_index = group["table"]
+            if table_index is not None and tokens_used + tokens[table_index] <= self.token_budget:
+                selected.append(table_index)
+                tokens_used += tokens[table_index]
+                # Column documents whose column is already described by the table document are redundant
+                candidates = [i for i in candidates if not self._is_covered(documents[i], texts[table_index])]
+            for i in candidates:
+                if tokens_used + tokens[i] <= self.token_budget:
+                    selected.append(i)
+                    tokens_used += tokens[i]
+
+        stats = SchemaContextStats(tokens_used, tokens_retrieved, len(selected), len(documents))
+        logger.info(f"Schema context built: {stats}")
+        return '\n'.join(texts[i] for i in selected), stats
+
+    def _is_covered(self, document: dict, table_text: str) -> bool:
+        metadata = document.get('metadata') or {}
+        column_name = metadata.get('column_name')
+        if not column_name:
+            return False
+        if is_compact_document(metadata):
+            # The table document lists every column, it only covers the ones it describes
+            return f"\n- {column_name} {metadata['column_type']}: " in table_text
+        return re.search(rf'\b{re.escape(column_name)}\b', table_text) is not None
@@ -0,0 +1,100 @@
+import re
+
+from .vector_store import COLUMN_DOCUMENT, TABLE_DOCUMENT
+
+"""
+
+    Canonical text of the schema documents, built once when the Glue tables are imported.
+    The texts are compact, without indentation nor Glue internals (SerDe, locations, parameters), so they are
+    embedded as is and pasted in the prompts without any processing. The same fields are stored as metadata.
+
+"""
+
+# Version of the document texts, stored with every document: a collection imported with another version is re-imported
+SCHEMA_DOCUMENT_FORMAT = 2
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def clean_text(text) -> str:
+    """Single line version of a description, the line feeds and the indentation only cost tokens."""
+    return _WHITESPACE.sub(' ', str(text or '')).strip()
+
+
+def partition_keys(table) -> list:
+    """Partition columns of a Glue table, they are not part of the StorageDescriptor columns."""
+    return table.get('PartitionKeys') or []
+
+
+def is_compact_document(metadata) -> bool:
+    """Checks whether a document text was built by this module and needs no processing before being used in a prompt."""
+    return bool(metadata) and metadata.get('document_format') == SCHEMA_DOCUMENT_FORMAT
+
+
+def _column_line(column) -> str:
+    comment = clean_text(column.get('Comment'))
+    return f"- {column['Name']} {column['Type']}: {comment}" if comment else f"- {column['Name']} {column['Type']}"
+
+
+def table_document(table, database_description) -> tuple:
+    """
+    Builds the document of a Glue table: its description, its columns and its partition keys.
+
+    Returns:
+    - (str, dict): The document text and its metadata.
+    """
+    database_name = table['DatabaseName']
+    table_name = table['Name']
+    table_description = clean_text(table.get('Description'))
+    columns = table['StorageDescriptor']['Columns']
+    partitions = partition_keys(table)
+
+    lines = [f"Table {database_name}.{table_name}" + (f": {table_description}" if table_description else "")]
+    if clean_text(database_description):
+        lines.append(f"Database {database_name}: {clean_text(database_description)}")
+    lines.append("Columns:")
+    lines.extend(_column_line(column) for column in columns)
+    if partitions:
+        lines.append("Partition keys:")
+        lines.extend(_column_line(column) for column in partitions)
+
+    metadata = {
+        "doc_kind": TABLE_DOCUMENT,
+        "document_format": SCHEMA_DOCUMENT_FORMAT,
+        "databaseName": database_name,
+        "tableName": table_name,
+        "database_name": database_name,
+        "table_name": table_name,
+        "database_description": database_description,
+        "table_description": table_description,
+        "table_type": table.get('TableType', ''),
+        "column_count": len(columns),
+        "partition_keys": ",".join(column['Name'] for column in partitions),
+    }
+    return "\n".join(lines), metadata
+
+
+def column_metadata(table, column, database_description, is_partition_key=False) -> dict:
+    return {
+        "doc_kind": COLUMN_DOCUMENT,
+        "document_format": SCHEMA_DOCUMENT_FORMAT,
+        "database_name": table['DatabaseName'],
+        "database_description": database_description,
+        "table_name": table['Name'],
+        "table_description": clean_text(table.get('Description')),
+        "column_name": column['Name'],
+        "column_type": column['Type'],
+        "column_description": column.get('Comment', ''),
+        "is_partition_key": is_partition_key,
+    }
+
+
+def column_document(metadata) -> str:
+    """Builds the document of a column from its metadata, once its description is known."""
+    text = f"Column {metadata['database_name']}.{metadata['table_name']}.{metadata['column_name']} {metadata['column_type']}"
+    if metadata['is_partition_key']:
+        text += " (partition key)"
+    description = clean_text(metadata['column_description'])
+    if description:
+        text += f": {description}"
+    return text
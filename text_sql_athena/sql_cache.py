@@ -0,0 +1,131 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from .custom_logger import logger
+
+"""
+
+    Semantic cache of the validated SQL queries.
+    A question close enough to a question already answered gets the cached SQL back without retrieval, generation or validation.
+
+"""
+
+# Numbers and quoted values of a question, they end up as literals of the SQL query
+_LITERALS = re.compile(r"\d+(?:[.:/-]\d+)*|'[^']*'|\"[^\"]*\"")
+_WORDS = re.compile(r"\w+")
+
+# Below this number of words, a different word (a host name, a status) changes the query as much as a literal
+SHORT_QUESTION_WORDS = 8
+
+
+def question_literals(question: str) -> list[str]:
+    return sorted(literal.lower() for literal in _LITERALS.findall(question))
+
+
+def same_parameters(question: str, other: str) -> bool:
+    """
+    Checks that two similar questions can share their SQL query: same numbers and quoted values,
+    same words for short questions. Their embeddings are close even when these differ.
+    """
+    if question_literals(question) != question_literals(other):
+        return False
+    words = set(_WORDS.findall(question.lower()))
+    other_words = set(_WORDS.findall(other.lower()))
+    if min(len(words), len(other_words)) <= SHORT_QUESTION_WORDS:
+        return words == other_words
+    return True
+
+
+class CachedSql:
+    def __init__(self, question: str, sql_query: str, tables: set):
+        self.question = question
+        self.sql_query = sql_query
+        self.tables = tables # "database.table" names used by the schema context
+        self.created_at = time.time()
+        self.hits = 0
+
+
+class SemanticSqlCache:
+    def __init__(self, similarity_threshold=0.95, ttl_seconds=24 * 3600, max_entries=1000):
+        """
+        Args:
+        - similarity_threshold (float): Minimum cosine similarity between two questions to reuse the SQL.
+        - ttl_seconds (float): Entries older than this are ignored and evicted.
+        - max_entries (int): Least recently used entries are evicted above this number.
+        """
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> CachedSql, in least recently used order
+        self.vectors = {}            # key -> normalized question embedding
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, query_embedding: list[float], question: str):
+        """Returns the CachedSql of the most similar question above the threshold with the same parameters, or None."""
+        query = _normalize(query_embedding)
+        with self.lock:
+            self._evict_expired()
+            if not self.entries:
+                self.misses += 1
+                return None
+            keys = list(self.vectors)
+            similarities = np.stack([self.vectors[key] for key in keys]) @ query
+            # Most similar first, a question with other literals is skipped for the next one
+            best = next((i for i in np.argsort(-similarities) if similarities[i] >= self.similarity_threshold
+                         and same_parameters(question, self.entries[keys[i]].question)), None)
+            if best is None:
+                self.misses += 1
+                return None
+            key = keys[best]
+            entry = self.entries[key]
+            self.entries.move_to_end(key)
+            entry.hits += 1
+            self.hits += 1
+        logger.info(f"SQL cache hit (similarity {similarities[best]:.3f}) for question: {entry.question}")
+        return entry
+
+    def store(self, question: str, query_embedding: list[float], sql_query: str, tables: set):
+        key = hashlib.sha256(question.encode('utf8')).hexdigest()
+        with self.lock:
+            self.entries[key] = CachedSql(question, sql_query, set(tables))
+            self.entries.move_to_end(key)
+            self.vectors[key] = _normalize(query_embedding)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                del self.vectors[evicted]
+
+    def invalidate_tables(self, database_name: str, table_names):
+        """Drops the entries generated against tables that were re-imported."""
+        tables = {f"{database_name}.{table_name}" for table_name in table_names}
+        with self.lock:
+            stale = [key for key, entry in self.entries.items() if entry.tables & tables]
+            for key in stale:
+                del self.entries[key]
+                del self.vectors[key]
+        if stale:
+            logger.info(f"{len(stale)} cached SQL queries invalidated")
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.vectors.clear()
+
+    def _evict_expired(self):
+        expiration = time.time() - self.ttl_seconds
+        expired = [key for key, entry in self.entries.items() if entry.created_at < expiration]
+        for key in expired:
+            del self.entries[key]
+            del self.vectors[key]
+
+
+def _normalize(vector) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm else array
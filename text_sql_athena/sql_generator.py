@@ -1,77 +1,424 @@
 # Contains the class to generate Sql query
 
+import asyncio
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from .athena_execution import AthenaQueryExecute
 from .aws_client_factory import AwsClientFactory
-from .chromadb_vc_embedding import EmbeddingBedrockChroma
+from .chromadb_vc_embedding import EmbeddingBedrockChroma, RetrievalContext
 from .llm_basemodel import LanguageModel
+from .rate_limiter import RateLimiter, call_with_throttling_retry
 from .custom_logger import logger
+from .schema_context_builder import document_table
+from .sql_cache import SemanticSqlCache
+from .sql_validator import LocalSqlValidator
+from .telemetry import telemetry
+
+SQL_GENERATION_INSTRUCTIONS = "It is important that the SQL query complies with Athena syntax. During join if column name are same please use alias ex llm.customer_id in select statement. It is also important to respect the type of columns: if a column is string, the value should be enclosed in quotes. If you are writing CTEs then include all the required columns. While concatenating a non string column, make sure cast the column to string. For date columns comparing to string , please cast the string input. Alwayws use the database name along with the table name. Write the SQL query in a ```sql block."
+
+
+def extract_sql(generated_text: str) -> str:
+    """Extracts the SQL statement of the first ``` block of a completion."""
+    query_str = generated_text.split("```")[1]
+    query_str = " ".join(query_str.split("\n")).strip()                    
+    return query_str[3:] if query_str.startswith("sql") else query_str
+
+
+def chunk_text(chunk) -> str:
+    """Returns the text of a streamed message chunk, whose content is either a string or a list of blocks."""
+    if isinstance(chunk.content, str):
+        return chunk.content
+    return "".join(block.get("text", "") for block in chunk.content if isinstance(block, dict))
+
+
+class NullMessageContainer:
+    """Stands for the Streamlit placeholder when SQL is generated without a UI, e.g. by the batch mode."""
+    def text(self, *args, **kwargs):
+        pass
+
+    markdown = text
+    error = text
+
+
+class SqlAnswer:
+    """SQL generated for a user question, with how it was obtained."""
+    def __init__(self, question: str, sql_query: str, validated: bool, attempts: int, context: RetrievalContext = None, from_cache=False):
+        self.question = question
+        self.sql_query = sql_query
+        self.validated = validated
+        self.attempts = attempts
+        self.context = context
+        self.from_cache = from_cache
+
+
+class _AttemptLoop:
+    """Attempt counting and retry history shared by the sync and async generation loops."""
+    def __init__(self, request, question, schema_context, max_attempt, message_container):
+        self.request = request
+        self.question = question
+        self.schema_context = schema_context
+        self.max_attempt = max_attempt
+        self.message_container = message_container
+        self.attempt = 0
+        self.failed_attempts = [] # (sql_query, error_message) of the rejected queries
+        self.sql_query = ""
+        self.validated = False
+
+    def remaining(self) -> bool:
+        return not self.validated and self.attempt < self.max_attempt
+
+    def start(self):
+        """Announces the next attempt and returns its header and the conversation to send."""
+        header = f"Generating SQL (Attempt {self.attempt + 1}/{self.max_attempt})..."
+        self.message_container.text(header)
+        logger.info(f'Sql Generation attempt Count: {self.attempt+1}')
+        # Only the latest failures are replayed, the conversation does not grow with the attempts
+        retry_history = self.request.retry_history
+        messages = self.request.build_messages(self.question, self.schema_context, self.failed_attempts[-retry_history:] if retry_history else [])
+        telemetry.increment("sql_attempts_total", attempt="retry" if self.attempt else "first")
+        return header, messages
+
+    def finish(self, sql_query, syntaxcheckmsg) -> bool:
+        """Records the validation of the generated query, returns True when it passed."""
+        self.attempt += 1
+        self.sql_query = sql_query
+        if syntaxcheckmsg == 'Passed':
+            logger.info(f'syntax checked for query passed in attempt number :{self.attempt}')
+            self.validated = True
+        else:
+            self.failed_attempts.append((sql_query, syntaxcheckmsg))
+        return self.validated
+
+    def fail(self, error):
+        """Records an attempt that raised before its query could be validated."""
+        logger.error(f'FAILED -> Sql Generation attempt Count: {self.attempt+1} {error}')
+        self.attempt += 1
+
+    def result(self):
+        """Returns the last query, whether it passed the validation and the number of attempts."""
+        if not self.validated:
+            self.message_container.error("Failed to generate valid SQL after multiple attempts.")
+        return self.sql_query, self.validated, self.attempt
+
 
 class RequestQueryBedrock:
-    def __init__(self, ebropen2: EmbeddingBedrockChroma, client_factory: AwsClientFactory, athena_bucket_name:str, language_model:LanguageModel):
+    def __init__(self, ebropen2: EmbeddingBedrockChroma, client_factory: AwsClientFactory, athena_bucket_name:str, language_model:LanguageModel, local_validation=True,
+                 prompt_caching=False, retry_history=1, sql_cache: SemanticSqlCache = None, speculative_candidates=1, speculative_temperature_step=0.3,
+                 database_name: str = None, query_executor: AthenaQueryExecute = None, llm_rate_limiter: RateLimiter = None):
         self.language_model = language_model
         self.embedding_generator = ebropen2
-        self.sqlsyntax_checker = AthenaQueryExecute(client_factory, athena_bucket_name)
+        # A shared executor carries the workgroup settings and the cache of the previous executions
+        self.sqlsyntax_checker = query_executor or AthenaQueryExecute(client_factory, athena_bucket_name)
+        # Obvious errors are caught locally, without an Athena round-trip
+        self.local_validator = LocalSqlValidator(ebropen2.get_schema_catalog) if local_validation and ebropen2 is not None else None
         self.llm = self.language_model.llm
+        # Mark the schema block as cacheable, for the models supporting Bedrock prompt caching
+        self.prompt_caching = prompt_caching
+        # Number of failed attempts replayed in the retry conversation
+        self.retry_history = retry_history
+        self.sql_cache = sql_cache
+        # Number of candidates generated and validated concurrently at each attempt, 1 disables the speculative mode
+        self.speculative_candidates = speculative_candidates
+        self.speculative_temperature_step = speculative_temperature_step
+        # Restricts the schema retrieval to the documents of a single database
+        self.database_name = database_name
+        # Shared by the concurrent requests of a batch, the model calls are also retried when throttled
+        self.llm_rate_limiter = llm_rate_limiter
         
-    def getEmbedding(self, user_query):
-        qresult=self.embedding_generator.get_similarity_search(user_query)
-        documents = self.embedding_generator.transform_data(qresult)
+    def getEmbedding(self, user_query, context: RetrievalContext = None):
+        if context is None:
+            context = self.embedding_generator.retrieve(user_query, database_name=self.database_name)
         
-        return self.embedding_generator.format_metadata(documents)
+        return context.schema_text
 
         
-    def generate_sql(self,prompt, message_container, max_attempt=4) ->str:
+    def answer(self, user_query: str, message_container=None, max_attempt=4, streaming=False, query_embedding: list[float] = None) -> SqlAnswer:
+        """
+        Answers a user question: reuses the SQL of a similar question already validated, or retrieves the schema and generates it.
+
+        Args:
+        - message_container: Streamlit placeholder showing the progress, None when there is no UI.
+        - query_embedding (list[float]): Embedding of the question when already computed, e.g. in a batch.
+
+        Returns:
+        - SqlAnswer: The SQL query and how it was obtained.
+        """
+        if query_embedding is None:
+            with telemetry.span("embed_question"):
+                query_embedding = self.embedding_generator.embeddings.embed_query(user_query)
+        cached_answer = self._cached_answer(user_query, query_embedding)
+        if cached_answer is not None:
+            return cached_answer
+
+        logger.info(f'Searching metadata from vector store')
+        with telemetry.span("retrieve"):
+            context = self.embedding_generator.retrieve(user_query, query_embedding=query_embedding, database_name=self.database_name)
+        with telemetry.span("generate_sql"):
+            sql_query, validated, attempts = self.generate_validated_sql(user_query, message_container, max_attempt, streaming, context.schema_text)
+        return self._make_answer(user_query, query_embedding, context, sql_query, validated, attempts)
+
+    async def aanswer(self, user_query: str, message_container=None, max_attempt=4, streaming=False) -> SqlAnswer:
+        """Async version of answer, independent steps run concurrently and no call blocks the event loop."""
+        # The schema catalog used by the local validation is warmed up while the question is embedded
+        warm_up = asyncio.to_thread(self.local_validator.catalog_provider) if self.local_validator else asyncio.sleep(0)
+        with telemetry.span("embed_question"):
+            query_embedding, _ = await asyncio.gather(self.embedding_generator.embeddings.aembed_query(user_query), warm_up)
+        cached_answer = self._cached_answer(user_query, query_embedding)
+        if cached_answer is not None:
+            return cached_answer
+
+        with telemetry.span("retrieve"):
+            context = await self.embedding_generator.aretrieve(user_query, query_embedding=query_embedding, database_name=self.database_name)
+        with telemetry.span("generate_sql"):
+            sql_query, validated, attempts = await self.agenerate_validated_sql(user_query, message_container, max_attempt, streaming, context.schema_text)
+        return self._make_answer(user_query, query_embedding, context, sql_query, validated, attempts)
+
+    def _cached_answer(self, user_query, query_embedding):
+        """Returns the answer of a similar question already validated against the searched database, None otherwise."""
+        if self.sql_cache is None:
+            return None
+        with telemetry.span("sql_cache_lookup"):
+            cached = self.sql_cache.lookup(query_embedding, user_query)
+        if cached is not None and self._in_searched_database(cached):
+            telemetry.record_cache("sql", hits=1)
+            return SqlAnswer(user_query, cached.sql_query, True, 0, from_cache=True)
+        telemetry.record_cache("sql", hits=0, misses=1)
+        return None
+
+    def _in_searched_database(self, cached) -> bool:
+        """Checks that a cached query was generated against the database the search is restricted to."""
+        return self.database_name is None or all(table.startswith(f"{self.database_name}.") for table in cached.tables)
+
+    def _make_answer(self, user_query, query_embedding, context: RetrievalContext, sql_query, validated, attempts) -> SqlAnswer:
+        if validated and self.sql_cache is not None:
+            tables = {f"{database}.{table}" for database, table, _ in map(document_table, context.documents)}
+            self.sql_cache.store(user_query, query_embedding, sql_query, tables)
+        return SqlAnswer(user_query, sql_query, validated, attempts, context=context)
+
+    def stream_sql(self, messages, message_container, header: str) -> str:
+        """
+        Streams the completion into the message container and stops as soon as the SQL block is closed.
+
+        Returns:
+        - string: The completion up to the closing ``` of the SQL block.
+        """
+        generated_text = ""
+        for chunk in self.llm.stream(messages):
+            telemetry.record_llm_usage(chunk, "sql_generation")
+            generated_text += chunk_text(chunk)
+            message_container.markdown(f"{header}\n\n{generated_text}")
+            if generated_text.count("```") >= 2:
+                # Closing the stream stops the generation, the trailing prose is never produced
+                logger.info("SQL block complete, stopping the generation")
+                break
+        return generated_text
+
+    async def astream_sql(self, messages, message_container, header: str) -> str:
+        """Async version of stream_sql."""
+        generated_text = ""
+        async for chunk in self.llm.astream(messages):
+            telemetry.record_llm_usage(chunk, "sql_generation")
+            generated_text += chunk_text(chunk)
+            message_container.markdown(f"{header}\n\n{generated_text}")
+            if generated_text.count("```") >= 2:
+                logger.info("SQL block complete, stopping the generation")
+                break
+        return generated_text
+
+    def build_messages(self, question: str, schema_context: str = None, failed_attempts: list = ()) -> list:
+        """
+        Builds the conversation sent to the model.
+
+        The instructions and the schema context form a stable system block, cacheable with Bedrock prompt caching.
+        Each failed attempt only adds the rejected SQL and its error.
+
+        Args:
+        - question (str): User question, or a complete prompt when schema_context is None.
+        - schema_context (str): Schema documents retrieved for the question.
+        - failed_attempts (list): (sql_query, error_message) of the previous attempts to correct.
+        """
+        messages = []
+        if schema_context is not None:
+            system_text = f"{SQL_GENERATION_INSTRUCTIONS}\n\nThe database schema is:\n{schema_context}"
+            if self.prompt_caching:
+                messages.append(SystemMessage(content=[{"type": "text", "text": system_text, "cache_control": {"type": "ephemeral"}}]))
+            else:
+                messages.append(SystemMessage(content=system_text))
+        messages.append(HumanMessage(content=question))
+        for sql_query, error_message in failed_attempts:
+            messages.append(AIMessage(content=f"```sql\n{sql_query}\n```"))
+            messages.append(HumanMessage(content=f"""This is syntax error: {error_message}. 
+To correct this, please generate an alternative SQL query which will correct the syntax error.
+The updated query should take care of all the syntax issues encountered.
+Follow the instructions mentioned above to remediate the error. 
+Make sure the updated SQL query aligns with the requirements provided in the initial question."""))
+        return messages
+
+    def generate_sql(self,question, message_container=None, max_attempt=4, streaming=False, schema_context=None) ->str:
             """
             Generate and Validate SQL query.
 
             Args:
-            - prompt (str): Prompt is user input and metadata from Rag to generating SQL.
+            - question (str): User question, or the complete prompt with the metadata from Rag when schema_context is None.
             - max_attempt (int): Maximum number of attempts correct the syntax SQL.
+            - streaming (bool): Render the tokens in message_container as they arrive and stop after the SQL block.
+            - schema_context (str): Metadata from Rag, sent once as a system block.
 
             Returns:
             - string: Sql query is returned .
             """
-            attempt = 0
-            error_messages = []
-            prompts = [prompt]  
-            sql_query = ""
-            while attempt < max_attempt:
-                message_container.text(f"Generating SQL (Attempt {attempt + 1}/{max_attempt})...") # Display attempt message
-                logger.info(f'Sql Generation attempt Count: {attempt+1}')
+            sql_query, _, _ = self.generate_validated_sql(question, message_container, max_attempt, streaming, schema_context)
+            return sql_query
+
+    def generate_validated_sql(self,question, message_container=None, max_attempt=4, streaming=False, schema_context=None):
+            """
+            Generate and Validate SQL query.
+
+            Args:
+            - question (str): User question, or the complete prompt with the metadata from Rag when schema_context is None.
+            - max_attempt (int): Maximum number of attempts correct the syntax SQL.
+            - streaming (bool): Render the tokens in message_container as they arrive and stop after the SQL block.
+            - schema_context (str): Metadata from Rag, sent once as a system block.
+
+            Returns:
+            - (str, bool, int): Sql query, whether it passed the validation and the number of attempts.
+            """
+            message_container = message_container or NullMessageContainer()
+            if self.speculative_candidates > 1:
+                return self.generate_speculative_sql(question, message_container, max_attempt, schema_context)
+            attempts = _AttemptLoop(self, question, schema_context, max_attempt, message_container)
+            while attempts.remaining():
+                header, messages = attempts.start()
                 try:
-                    logger.info(f'we are in Try block to generate the sql and count is :{attempt+1}')
-                    generated_sql = self.llm.predict(prompt)
+                    with telemetry.span("llm_generation"):
+                        if streaming:
+                            generated_sql = self.stream_sql(messages, message_container, header)
+                        else:
+                            generated_sql = self._invoke(messages)
                     logger.info(f"Generated sql : {generated_sql}")
-                    query_str = generated_sql.split("```")[1]
-                    query_str = " ".join(query_str.split("\n")).strip()                    
-                    sql_query = query_str[3:] if query_str.startswith("sql") else query_str
-                    logger.info(sql_query)
-                    # return sql_query
-                    syntaxcheckmsg=self.sqlsyntax_checker.syntax_checker(sql_query)
-                    if syntaxcheckmsg=='Passed':
-                        logger.info(f'syntax checked for query passed in attempt number :{attempt+1}')
-                        return sql_query
-                    else:
-                        prompt = f"""{prompt}
-                        This is syntax error: {syntaxcheckmsg}. 
-                        To correct this, please generate an alternative SQL query which will correct the syntax error.
-                        The updated query should take care of all the syntax issues encountered.
-                        Follow the instructions mentioned above to remediate the error. 
-                        Update the below SQL query to resolve the issue:
-                        {sql_query}
-                        Make sure the updated SQL query aligns with the requirements provided in the initial question."""
-                        prompts.append(prompt)
-                        attempt += 1
+                    sql_query = extract_sql(generated_sql)
+                    attempts.finish(sql_query, self._validate(sql_query))
                 except Exception as e:
-                    logger.info(e)
-                    msg = str(e)                    
-                    logger.error(f'FAILED -> Sql Generation attempt Count: {attempt+1} {e}')
-                    error_messages.append(msg)
-                    attempt += 1
-                    
-            # Display a final message if all attempts fail
-            if attempt == max_attempt:
-                message_container.error("Failed to generate valid SQL after multiple attempts.")
-                    
-            return sql_query
\ No newline at end of file
+                    attempts.fail(e)
+            return attempts.result()
+
+
+    def generate_speculative_sql(self, question, message_container=None, max_attempt=4, schema_context=None, candidates=None):
+        """
+        Generates several candidates concurrently at each attempt, with increasing temperatures, and validates them in parallel.
+        The first valid candidate is returned and the validations still running are cancelled.
+        Trades extra Bedrock calls for a lower latency on hard questions, the output is not streamed.
+
+        Returns:
+        - (str, bool, int): Sql query, whether it passed the validation and the number of attempts.
+        """
+        message_container = message_container or NullMessageContainer()
+        candidates = candidates or self.speculative_candidates
+        models = [self._llm_with_temperature(min(1.0, i * self.speculative_temperature_step)) for i in range(candidates)]
+        failed_attempts = []
+        sql_query = ""
+        executor = ThreadPoolExecutor(max_workers=candidates)
+        try:
+            for attempt in range(max_attempt):
+                message_container.text(f"Generating {candidates} SQL candidates (Attempt {attempt + 1}/{max_attempt})...")
+                logger.info(f'Speculative Sql Generation attempt Count: {attempt+1}')
+                messages = self.build_messages(question, schema_context, failed_attempts[-self.retry_history:] if self.retry_history else [])
+                telemetry.increment("sql_attempts_total", candidates, attempt="retry" if attempt else "first")
+                cancel_event = threading.Event()
+                futures = [executor.submit(self._generate_candidate, messages, llm, cancel_event) for llm in models]
+                try:
+                    for future in as_completed(futures):
+                        try:
+                            candidate, syntaxcheckmsg = future.result()
+                        except Exception as e:
+                            logger.error(f'FAILED -> Sql candidate generation: {e}')
+                            continue
+                        if syntaxcheckmsg == 'Passed':
+                            logger.info(f'syntax checked for query passed in attempt number :{attempt+1}')
+                            return candidate, True, attempt + 1
+                        sql_query = candidate
+                        failed_attempts.append((candidate, syntaxcheckmsg))
+                finally:
+                    # Stop the candidates still generating or being validated
+                    cancel_event.set()
+                    for future in futures:
+                        future.cancel()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        message_container.error("Failed to generate valid SQL after multiple attempts.")
+        return sql_query, False, max_attempt
+
+    def _llm_with_temperature(self, temperature):
+        """Copy of the model sampling at another temperature, a temperature passed to invoke is overridden by the model settings."""
+        model_kwargs = dict(self.llm.model_kwargs or {})
+        if "temperature" in model_kwargs:
+            model_kwargs["temperature"] = temperature
+        return self.llm.model_copy(update={"temperature": temperature, "model_kwargs": model_kwargs})
+
+    def _generate_candidate(self, messages, llm, cancel_event: threading.Event):
+        with telemetry.span("llm_generation"):
+            generated_sql = self._invoke(messages, llm)
+        sql_query = extract_sql(generated_sql)
+        if cancel_event.is_set():
+            return sql_query, "Cancelled"
+        return sql_query, self._validate(sql_query, cancel_event)
+
+    def _invoke(self, messages, llm=None) -> str:
+        response = call_with_throttling_retry((llm or self.llm).invoke, messages, rate_limiter=self.llm_rate_limiter)
+        telemetry.record_llm_usage(response, "sql_generation")
+        return chunk_text(response)
+
+    def _validate(self, sql_query, cancel_event: threading.Event = None) -> str:
+        """Validates the query locally, then with an Athena EXPLAIN, and returns 'Passed' or the error messages."""
+        with telemetry.span("local_validation"):
+            local_errors = self._local_check(sql_query)
+        if local_errors:
+            return local_errors
+        with telemetry.span("athena_validation"):
+            return self.sqlsyntax_checker.syntax_checker(sql_query, cancel_event=cancel_event)
+
+    async def agenerate_sql(self, question, message_container=None, max_attempt=4, streaming=False, schema_context=None) -> str:
+        """Async version of generate_sql."""
+        sql_query, _, _ = await self.agenerate_validated_sql(question, message_container, max_attempt, streaming, schema_context)
+        return sql_query
+
+    async def agenerate_validated_sql(self, question, message_container=None, max_attempt=4, streaming=False, schema_context=None):
+        """Async version of generate_validated_sql, the model and Athena calls do not block the event loop."""
+        message_container = message_container or NullMessageContainer()
+        attempts = _AttemptLoop(self, question, schema_context, max_attempt, message_container)
+        while attempts.remaining():
+            header, messages = attempts.start()
+            try:
+                with telemetry.span("llm_generation"):
+                    if streaming:
+                        generated_sql = await self.astream_sql(messages, message_container, header)
+                    else:
+                        response = await self.llm.ainvoke(messages)
+                        telemetry.record_llm_usage(response, "sql_generation")
+                        generated_sql = chunk_text(response)
+                logger.info(f"Generated sql : {generated_sql}")
+                sql_query = extract_sql(generated_sql)
+                attempts.finish(sql_query, await self._avalidate(sql_query))
+            except Exception as e:
+                attempts.fail(e)
+        return attempts.result()
+
+    async def _avalidate(self, sql_query) -> str:
+        """Async version of _validate, the local check reads the schema catalog in a thread."""
+        with telemetry.span("local_validation"):
+            local_errors = await asyncio.to_thread(self._local_check, sql_query)
+        if local_errors:
+            return local_errors
+        with telemetry.span("athena_validation"):
+            return await self.sqlsyntax_checker.asyntax_checker(sql_query)
+
+    def _local_check(self, sql_query):
+        """Returns the local validation errors as a single message, None when the query can be sent to Athena."""
+        local_errors = self.local_validator.validate(sql_query) if self.local_validator else []
+        if local_errors:
+            logger.info(f'Local validation failed: {local_errors}')
+            return " ".join(local_errors)
+        return None
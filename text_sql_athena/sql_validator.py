@@ -0,0 +1,159 @@
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+from sqlglot.optimizer.scope import traverse_scope
+
+from .custom_logger import logger
+
+"""
+
+    Local validation of the generated SQL before sending it to Athena.
+    The statement is parsed with the Athena (Trino) dialect and its table and column references are checked
+    against the Glue schema imported in the vector database.
+
+"""
+
+# Maximum number of available columns listed in an error message
+MAX_LISTED_COLUMNS = 50
+
+# Databases provided by Athena itself, never imported from Glue
+SYSTEM_DATABASES = ("information_schema",)
+
+# Hidden columns Athena adds to every table, never part of the Glue schema
+HIDDEN_COLUMNS = ("$path", "$file_size", "$file_modified_time", "$bucket", "$partition")
+
+
+def check_balanced(sql: str) -> list[str]:
+    """Checks that parentheses and quotes are balanced, ignoring string literals, quoted identifiers and comments."""
+    depth = 0
+    quote = None
+    i = 0
+    while i < len(sql):
+        char = sql[i]
+        if quote:
+            if char == quote:
+                quote = None
+        elif sql.startswith('--', i):
+            end = sql.find('\n', i)
+            i = len(sql) if end < 0 else end
+        elif sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            i = len(sql) if end < 0 else end + 1
+        elif char in ("'", '"'):
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth < 0:
+                return [f"Unbalanced parentheses: unexpected ')' at position {i}"]
+        i += 1
+    if quote:
+        return [f"Unterminated {'string literal' if quote == chr(39) else 'quoted identifier'}"]
+    if depth > 0:
+        return [f"Unbalanced parentheses: {depth} '(' not closed"]
+    return []
+
+
+class LocalSqlValidator:
+    def __init__(self, catalog_provider, dialect="athena"):
+        """
+        Args:
+        - catalog_provider: Callable returning the imported schema as {database: {table: set(columns)}}, names in lower case.
+        - dialect (str): sqlglot dialect used to parse the statements.
+        """
+        self.catalog_provider = catalog_provider
+        self.dialect = dialect
+
+    def validate(self, sql: str) -> list[str]:
+        """
+        Validates a statement locally.
+
+        Only errors that Athena would report for sure are returned. Statements that sqlglot cannot parse,
+        or that reference databases not imported, are left to the Athena EXPLAIN.
+
+        Returns:
+        - list: Error messages, empty when the statement passed.
+        """
+        errors = check_balanced(sql)
+        if errors:
+            return errors
+
+        try:
+            expression = sqlglot.parse_one(sql, read=self.dialect)
+        except SqlglotError as e:
+            logger.info(f"Statement not parsed locally, deferring to Athena: {e}")
+            return []
+
+        catalog = self.catalog_provider()
+        if not catalog:
+            return []
+
+        errors = []
+        for table in expression.find_all(exp.Table):
+            error = self._check_table(catalog, table)
+            if error:
+                errors.append(error)
+        if errors:
+            return errors
+
+        try:
+            scopes = traverse_scope(expression)
+        except SqlglotError as e:
+            logger.info(f"Unable to resolve the scopes locally: {e}")
+            return []
+        for scope in scopes:
+            errors.extend(self._check_columns(catalog, scope))
+        return list(dict.fromkeys(errors))
+
+    def _resolve(self, catalog, table: exp.Table):
+        """Returns the known columns of a table, or None when the table is not part of the imported schema."""
+        database = table.db.lower()
+        name = table.name.lower()
+        if database:
+            return catalog.get(database, {}).get(name)
+        matches = [tables[name] for tables in catalog.values() if name in tables]
+        return matches[0] if len(matches) == 1 else None
+
+    def _check_table(self, catalog, table: exp.Table):
+        database = table.db.lower()
+        name = table.name.lower()
+        if not database or database in SYSTEM_DATABASES or database not in catalog or table.catalog:
+            return None
+        if name not in catalog[database]:
+            return f"Table {name} does not exist in database {database}. Available tables: {', '.join(sorted(catalog[database])[:MAX_LISTED_COLUMNS])}"
+        return None
+
+    def _check_columns(self, catalog, scope) -> list[str]:
+        errors = []
+        # Columns of the base tables of the scope, None when a source is a subquery, a CTE or an unnest
+        sources = {}
+        for alias, source in scope.sources.items():
+            sources[alias.lower()] = self._resolve(catalog, source) if isinstance(source, exp.Table) else None
+        select_aliases = set()
+        if isinstance(scope.expression, exp.Select):
+            select_aliases = {select.alias.lower() for select in scope.expression.selects if isinstance(select, exp.Alias)}
+        # A name unknown to a nested scope may be a correlated reference to a column of an outer query
+        may_be_correlated = scope.parent is not None and not scope.is_cte
+
+        for column in scope.columns:
+            name = column.name.lower()
+            if not name or name == '*' or name in HIDDEN_COLUMNS:
+                continue
+            if isinstance(scope.expression, exp.Select) and column.find_ancestor(exp.Select) is not scope.expression:
+                # Reference of a nested subquery, checked with the scope of that subquery
+                continue
+            qualifier = column.table.lower()
+            if qualifier:
+                columns = sources.get(qualifier)
+                if columns and name not in columns:
+                    errors.append(self._column_error(name, qualifier, columns))
+            elif sources and all(sources.values()) and name not in select_aliases and not may_be_correlated:
+                if not any(name in columns for columns in sources.values()):
+                    available = set().union(*sources.values())
+                    errors.append(self._column_error(name, ', '.join(sources), available))
+        return errors
+
+    def _column_error(self, name, table, columns):
+        available = ', '.join(sorted(columns)[:MAX_LISTED_COLUMNS])
+        return f"Column {name} cannot be resolved in {table}. Available columns: {available}"
@@ -0,0 +1,202 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .custom_logger import logger
+
+"""
+
+    In-process metrics of the text-to-SQL pipeline: timed spans around each stage and counters for the
+    tokens, the attempts, the bytes scanned by Athena and the caches, exported in the Prometheus text format.
+    Recording is a dictionary update under a lock, cheap enough to stay enabled.
+
+"""
+
+# Upper bounds, in seconds, of the buckets of the stage duration histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Help texts of the exported metrics
+DESCRIPTIONS = {
+    "stage_duration_seconds": "Duration of the stages of the text-to-SQL requests.",
+    "stage_errors_total": "Stages that raised an exception.",
+    "llm_tokens_total": "Tokens sent to and generated by the model.",
+    "sql_attempts_total": "SQL generation attempts, retries included.",
+    "throttling_retries_total": "Calls retried after a throttling error.",
+    "athena_queries_total": "Athena executions by final state.",
+    "athena_data_scanned_bytes_total": "Bytes scanned by the Athena executions.",
+    "cache_hits_total": "Cache hits by cache.",
+    "cache_misses_total": "Cache misses by cache.",
+    "athena_scheduler_queue_depth": "Athena executions waiting for a slot of the scheduler.",
+    "athena_scheduler_running": "Athena executions admitted by the scheduler and not finished.",
+    "athena_scheduler_limit": "Current concurrency limit of the scheduler, lowered when Athena throttles.",
+    "athena_scheduler_wait_seconds": "Time spent by the executions waiting for a slot of the scheduler.",
+    "athena_scheduler_coalesced_total": "Executions answered by an identical execution already in flight.",
+    "athena_scheduler_throttled_total": "Athena throttling errors reported to the scheduler.",
+}
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in items) + "}"
+
+
+class Telemetry:
+    def __init__(self, namespace="textsql", buckets=DEFAULT_BUCKETS, payload_sample_rate=0.01):
+        """
+        Args:
+        - namespace (str): Prefix of the exported metric names.
+        - buckets (tuple): Upper bounds of the histogram buckets, in seconds.
+        - payload_sample_rate (float): Ratio of the payloads (prompts, Glue tables) actually logged by log_payload.
+        """
+        self.namespace = namespace
+        self.buckets = buckets
+        self.payload_sample_rate = payload_sample_rate
+        self.lock = threading.Lock()
+        self.counters = {}   # (name, labels) -> value
+        self.gauges = {}     # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self._server = None
+
+    def increment(self, name: str, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value, **labels):
+        key = (name, _labels_key(labels))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _labels_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(self.buckets)] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def span(self, stage: str):
+        """Times a stage of a request into the stage_duration_seconds histogram, failures are counted too."""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.increment("stage_errors_total", stage=stage)
+            raise
+        finally:
+            self.observe("stage_duration_seconds", time.perf_counter() - start, stage=stage)
+
+    def record_llm_usage(self, message, stage: str):
+        """Counts the tokens reported in the usage metadata of a model response or of the last streamed chunk."""
+        usage = getattr(message, 'usage_metadata', None)
+        if not usage:
+            return
+        self.increment("llm_tokens_total", usage.get('input_tokens', 0), direction="in", stage=stage)
+        self.increment("llm_tokens_total", usage.get('output_tokens', 0), direction="out", stage=stage)
+
+    def record_cache(self, cache: str, hits: int, misses: int = 0):
+        if hits:
+            self.increment("cache_hits_total", hits, cache=cache)
+        if misses:
+            self.increment("cache_misses_total", misses, cache=cache)
+
+    def log_payload(self, message: str, *args):
+        """Logs a large payload for a sample of the calls only, the message is formatted only when it is logged."""
+        if self.payload_sample_rate >= 1 or random.random() < self.payload_sample_rate:
+            logger.info(message, *args)
+
+    def snapshot(self) -> dict:
+        """Returns the counters, the gauges and the histogram sums and counts, keyed by metric name and labels."""
+        with self.lock:
+            result = {f"{name}{_format_labels(labels)}": value for (name, labels), value in self.counters.items()}
+            result.update({f"{name}{_format_labels(labels)}": value for (name, labels), value in self.gauges.items()})
+            for (name, labels), histogram in self.histograms.items():
+                result[f"{name}_count{_format_labels(labels)}"] = sum(histogram[:-1])
+                result[f"{name}_sum{_format_labels(labels)}"] = histogram[-1]
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def render_prometheus(self) -> str:
+        """Renders every metric in the Prometheus text exposition format."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+        lines = []
+        described = set()
+
+        def describe(name, metric_type):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {self.namespace}_{name} {DESCRIPTIONS.get(name, name)}")
+                lines.append(f"# TYPE {self.namespace}_{name} {metric_type}")
+
+        for (name, labels), value in counters:
+            describe(name, "counter")
+            lines.append(f"{self.namespace}_{name}{_format_labels(labels)} {value}")
+        for (name, labels), value in gauges:
+            describe(name, "gauge")
+            lines.append(f"{self.namespace}_{name}{_format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), histogram[:-1]):
+                cumulative += count
+                lines.append(f"{self.namespace}_{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{self.namespace}_{name}_sum{_format_labels(labels)} {histogram[-1]}")
+            lines.append(f"{self.namespace}_{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def start_http_server(self, port: int, address="0.0.0.0"):
+        """Serves /metrics for Prometheus from a daemon thread, once per process."""
+        if self._server is not None:
+            return self._server
+        telemetry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = telemetry.render_prometheus().encode('utf8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((address, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info(f"Metrics served on http://{address}:{self._server.server_address[1]}/metrics")
+        return self._server
+
+
+# Process-wide instance used by every component
+telemetry = Telemetry()
@@ -0,0 +1,347 @@
+import abc
+import json
+import os
+import threading
+
+import numpy as np
+
+from .custom_logger import logger
+
+"""
+
+    Storage and similarity search of the schema documents.
+    EmbeddingBedrockChroma works with any VectorStore: Chroma persistent collections, or a numpy index
+    partitioned per document kind and memory-mapped from disk for very large catalogs.
+    Results are returned with the Chroma QueryResult layout whatever the backend.
+
+"""
+
+# Kinds of documents produced by the Glue import
+TABLE_DOCUMENT = "table"
+COLUMN_DOCUMENT = "column"
+DOCUMENT_KINDS = (TABLE_DOCUMENT, COLUMN_DOCUMENT)
+
+
+def document_kind(metadata: dict) -> str:
+    """Kind of a document, documents imported before doc_kind existed are recognized by their keys."""
+    metadata = metadata or {}
+    return metadata.get('doc_kind') or (COLUMN_DOCUMENT if 'column_name' in metadata else TABLE_DOCUMENT)
+
+
+def kind_filter(where: dict, doc_kind: str) -> dict:
+    """Combines a where filter with a restriction on the document kind."""
+    if doc_kind is None:
+        return where
+    if not where:
+        return {"doc_kind": doc_kind}
+    return {"$and": [where, {"doc_kind": doc_kind}]}
+
+
+class VectorStore(abc.ABC):
+    """Interface of the vector stores, the filters use the Chroma where syntax."""
+
+    @abc.abstractmethod
+    def add(self, ids: list[str], documents: list[str], embeddings: list[list[float]], metadatas: list[dict]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get(self, ids: list[str] = None, where: dict = None, include_documents=False) -> dict:
+        """Returns {'ids': [...], 'metadatas': [...], 'documents': [...]} of the matching documents, the texts only when include_documents is set."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, ids: list[str]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def query(self, query_embedding: list[float], n_results: int, where: dict = None) -> dict:
+        """Returns the n_results nearest documents with the Chroma QueryResult layout."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def persist(self):
+        """Writes the pending changes to disk, for the backends that do not persist every write."""
+
+
+class ChromaVectorStore(VectorStore):
+    def __init__(self, chromadb_path="chroma.db", collection_name="athena_embed_collection"):
+        # Opening the persistent client loads the collection from disk, it runs in the background
+        # and the first access to the collection waits for it
+        self._chroma_client = None
+        self._collection = None
+        self._open_error = None
+        self._opened = threading.Event()
+        threading.Thread(target=self._open_collection, args=(chromadb_path, collection_name), daemon=True).start()
+
+    def _open_collection(self, chromadb_path, collection_name):
+        try:
+            # Imported here, chromadb is slow to import and only needed by this backend
+            import chromadb
+            self._chroma_client = chromadb.PersistentClient(path=chromadb_path)
+            if not self.check_if_collection_exists(collection_name):  # Check if collection exists
+                self._collection = self._chroma_client.get_or_create_collection(name=collection_name)
+                logger.warning(f"Collection '{collection_name}' created.") #confirmation message to user.
+            else:
+                self._collection = self._chroma_client.get_collection(name=collection_name) # Get collection if exist
+                logger.info(f"Collection '{collection_name}' already exists. Loading existing collection.")
+        except Exception as e:
+            logger.error(f"Failed to open the Chroma collection '{collection_name}': {e}")
+            self._open_error = e
+        finally:
+            self._opened.set()
+
+    def check_if_collection_exists(self, collection_name: str):
+        try:
+            self._chroma_client.get_collection(name=collection_name)
+            return True  # Collection exists
+        except Exception as e:
+            if "does not exist" in str(e):  # Specific error for non-existent collection
+                return False  # Collection does not exist
+            else:
+                raise  # Re-raise other exceptions
+
+    @property
+    def chroma_client(self):
+        self._wait_until_opened()
+        return self._chroma_client
+
+    @property
+    def collection(self):
+        self._wait_until_opened()
+        return self._collection
+
+    def _wait_until_opened(self):
+        self._opened.wait()
+        if self._open_error is not None:
+            raise self._open_error
+
+    def add(self, ids, documents, embeddings, metadatas):
+        self.collection.add(ids=ids, documents=documents, embeddings=embeddings, metadatas=metadatas)
+
+    def get(self, ids=None, where=None, include_documents=False):
+        entries = self.collection.get(ids=ids, where=where or None, include=["metadatas", "documents"] if include_documents else ["metadatas"])
+        return {"ids": entries['ids'], "documents": entries['documents'], "metadatas": entries['metadatas']}
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def query(self, query_embedding, n_results, where=None):
+        return self.collection.query(query_embeddings=query_embedding, n_results=n_results, where=where or None)
+
+    def count(self):
+        return self.collection.count()
+
+
+class _Partition:
+    """Documents of one kind: a matrix of normalized vectors and the ids, texts and metadata of its rows."""
+    def __init__(self, vectors: np.ndarray, ids: list, documents: list, metadatas: list):
+        self.vectors = vectors
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.rows = {doc_id: row for row, doc_id in enumerate(ids)}
+        self.fields = {} # metadata key -> array of the values of every row, built on first filter
+        self.buffer = None # Preallocated matrix vectors is a view of, grown geometrically by append
+
+    def append(self, vectors: np.ndarray, ids: list, documents: list, metadatas: list):
+        """Appends rows in amortized constant time per row, instead of copying the whole matrix at every write."""
+        count = len(self.ids)
+        needed = count + len(ids)
+        if self.buffer is None or needed > len(self.buffer) or (count and self.vectors.shape[1] != vectors.shape[1]):
+            self.buffer = np.empty((max(needed, 2 * count, 1024), vectors.shape[1]), dtype=np.float32)
+            if count:
+                self.buffer[:count] = self.vectors
+        self.buffer[count:needed] = vectors
+        self.vectors = self.buffer[:needed]
+        for doc_id in ids:
+            self.rows[doc_id] = len(self.ids)
+            self.ids.append(doc_id)
+        self.documents.extend(documents)
+        self.metadatas.extend(metadatas)
+        self.fields = {}
+
+    def field(self, key: str) -> np.ndarray:
+        values = self.fields.get(key)
+        if values is None:
+            values = np.empty(len(self.metadatas), dtype=object)
+            if key == "doc_kind":
+                values[:] = [document_kind(metadata) for metadata in self.metadatas]
+            else:
+                values[:] = [(metadata or {}).get(key) for metadata in self.metadatas]
+            self.fields[key] = values
+        return values
+
+
+class NumpyVectorStore(VectorStore):
+    def __init__(self, path: str, mmap=True):
+        """
+        Exact cosine similarity search over in-memory matrices, one per document kind.
+
+        Args:
+        - path (str): Directory of the index, created by persist().
+        - mmap (bool): Memory-maps the stored matrices instead of reading them, the OS pages in the rows searched.
+        """
+        self.path = path
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.partitions = {kind: self._load(kind, mmap) for kind in DOCUMENT_KINDS}
+
+    def _load(self, kind, mmap):
+        vectors_file = os.path.join(self.path, f"{kind}.npy")
+        documents_file = os.path.join(self.path, f"{kind}.json")
+        if not os.path.exists(vectors_file) or not os.path.exists(documents_file):
+            return _Partition(np.empty((0, 0), dtype=np.float32), [], [], [])
+        with open(documents_file, encoding='utf8') as f:
+            stored = json.load(f)
+        vectors = np.load(vectors_file, mmap_mode='r' if mmap else None)
+        logger.info(f"{len(stored['ids'])} {kind} documents loaded from {self.path}")
+        return _Partition(vectors, stored['ids'], stored['documents'], stored['metadatas'])
+
+    def add(self, ids, documents, embeddings, metadatas):
+        vectors = _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        with self.lock:
+            # Existing documents are replaced
+            self.delete(ids)
+            for kind in DOCUMENT_KINDS:
+                rows = [i for i, metadata in enumerate(metadatas) if document_kind(metadata) == kind]
+                if not rows:
+                    continue
+                self.partitions[kind].append(vectors[rows], [ids[i] for i in rows], [documents[i] for i in rows], [metadatas[i] for i in rows])
+            self.dirty = True
+
+    def get(self, ids=None, where=None, include_documents=False):
+        result = {"ids": [], "documents": [] if include_documents else None, "metadatas": []}
+        with self.lock:
+            for partition in self.partitions.values():
+                if ids is not None:
+                    rows = [partition.rows[doc_id] for doc_id in ids if doc_id in partition.rows]
+                    if where:
+                        mask = self._where_mask(partition, where)
+                        rows = [row for row in rows if mask[row]]
+                else:
+                    rows = np.flatnonzero(self._where_mask(partition, where)) if where else range(len(partition.ids))
+                for row in rows:
+                    result["ids"].append(partition.ids[row])
+                    if include_documents:
+                        result["documents"].append(partition.documents[row])
+                    result["metadatas"].append(partition.metadatas[row])
+        return result
+
+    def delete(self, ids):
+        with self.lock:
+            for kind, partition in self.partitions.items():
+                rows = {partition.rows[doc_id] for doc_id in ids if doc_id in partition.rows}
+                if not rows:
+                    continue
+                keep = [row for row in range(len(partition.ids)) if row not in rows]
+                self.partitions[kind] = _Partition(np.asarray(partition.vectors[keep]),
+                                                   [partition.ids[row] for row in keep],
+                                                   [partition.documents[row] for row in keep],
+                                                   [partition.metadatas[row] for row in keep])
+                self.dirty = True
+
+    def query(self, query_embedding, n_results, where=None):
+        query = _normalize_rows(np.asarray(query_embedding, dtype=np.float32).reshape(1, -1))[0]
+        hits = [] # (distance, partition, row)
+        with self.lock:
+            partitions = self._searched_partitions(where)
+            for partition in partitions:
+                if not partition.ids:
+                    continue
+                if where:
+                    rows = np.flatnonzero(self._where_mask(partition, where))
+                    if len(rows) == 0:
+                        continue
+                    # Only the rows passing the filter are scored
+                    similarities = np.asarray(partition.vectors[rows]) @ query
+                else:
+                    rows = np.arange(len(partition.ids))
+                    similarities = np.asarray(partition.vectors @ query)
+                best = _top_k(similarities, n_results)
+                hits.extend((1.0 - float(similarities[i]), partition, int(rows[i])) for i in best)
+
+        hits.sort(key=lambda hit: hit[0])
+        hits = hits[:n_results]
+        return {
+            "ids": [[partition.ids[row] for _, partition, row in hits]],
+            "documents": [[partition.documents[row] for _, partition, row in hits]],
+            "metadatas": [[partition.metadatas[row] for _, partition, row in hits]],
+            "distances": [[distance for distance, _, _ in hits]],
+        }
+
+    def count(self):
+        return sum(len(partition.ids) for partition in self.partitions.values())
+
+    def persist(self):
+        """Writes the matrices and the documents of every partition, replacing the previous files atomically."""
+        with self.lock:
+            if not self.dirty:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            for kind, partition in self.partitions.items():
+                vectors_file = os.path.join(self.path, f"{kind}.npy")
+                documents_file = os.path.join(self.path, f"{kind}.json")
+                with open(vectors_file + ".tmp", 'wb') as f:
+                    np.save(f, np.asarray(partition.vectors, dtype=np.float32))
+                with open(documents_file + ".tmp", 'w', encoding='utf8') as f:
+                    json.dump({"ids": partition.ids, "documents": partition.documents, "metadatas": partition.metadatas}, f)
+                os.replace(vectors_file + ".tmp", vectors_file)
+                os.replace(documents_file + ".tmp", documents_file)
+            self.dirty = False
+        logger.info(f"Vector index persisted to {self.path}: {self.count()} documents")
+
+    def _searched_partitions(self, where):
+        """Partitions a filter can match, a doc_kind equality at the top level of the filter selects a single partition."""
+        conditions = where.get("$and", [where]) if where else []
+        for condition in conditions:
+            kind = condition.get("doc_kind")
+            if isinstance(kind, dict):
+                kind = kind.get("$eq")
+            if kind in self.partitions:
+                return [self.partitions[kind]]
+        return list(self.partitions.values())
+
+    def _where_mask(self, partition: _Partition, where: dict) -> np.ndarray:
+        """Evaluates a Chroma where filter ($and, $or, $eq, $ne, $in, $nin and plain equality) on every row of a partition."""
+        mask = np.ones(len(partition.ids), dtype=bool)
+        for key, condition in where.items():
+            if key == "$and":
+                for sub_filter in condition:
+                    mask &= self._where_mask(partition, sub_filter)
+            elif key == "$or":
+                any_mask = np.zeros(len(partition.ids), dtype=bool)
+                for sub_filter in condition:
+                    any_mask |= self._where_mask(partition, sub_filter)
+                mask &= any_mask
+            else:
+                values = partition.field(key)
+                operator, operand = next(iter(condition.items())) if isinstance(condition, dict) else ("$eq", condition)
+                if operator == "$eq":
+                    mask &= values == operand
+                elif operator == "$ne":
+                    mask &= values != operand
+                elif operator == "$in":
+                    mask &= np.isin(values, list(operand))
+                elif operator == "$nin":
+                    mask &= ~np.isin(values, list(operand))
+                else:
+                    raise ValueError(f"Unsupported where operator: {operator}")
+        return mask
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _top_k(similarities: np.ndarray, k: int) -> np.ndarray:
+    """Indexes of the k highest similarities, in decreasing order, without sorting the whole array."""
+    if k < len(similarities):
+        candidates = np.argpartition(-similarities, k - 1)[:k]
+    else:
+        candidates = np.arange(len(similarities))
+    return candidates[np.argsort(-similarities[candidates])]